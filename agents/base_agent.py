@@ -1,5 +1,6 @@
 from models.base_model import BaseModel
 from mydatasets.base_dataset import BaseDataset
+from utils.profiler import profiler
 import os
 from typing import Dict, Union
 import json
@@ -8,9 +9,17 @@ from tqdm import tqdm
 import re
 import importlib
 
+class AgentCall:
+    """One model call of an agent. Agent flows yield it and receive the (answer, messages) of model.predict."""
+    def __init__(self, agent, stage, request):
+        self.agent = agent
+        self.stage = stage
+        self.request = request
+
 class Agent:
     def __init__(self, config, model=None):
         self.config = config
+        self.name = self.config.agent.name
         self.messages = None
         if model is not None:
             self.model:BaseModel = model
@@ -23,12 +32,19 @@ class Agent:
     def clean_messages(self):
         self.messages = None
         
-    def _predict(self, question, texts=None, images=None, add_to_message = False):
+    def call(self, question, texts=None, images=None, history=None, with_sys_prompt=False, stage=None):
+        if with_sys_prompt:
+            question = self.config.agent.system_prompt + question
         if not self.config.agent.use_text:
             texts = None
         if not self.config.agent.use_image:
             images = None
-        generated_ans, messages = self.model.predict(question, texts, images, self.messages)
+        return AgentCall(self, stage or self.name, {"question": question, "texts": texts, "images": images, "history": history})
+    
+    def _predict(self, question, texts=None, images=None, add_to_message = False, stage = None):
+        call = self.call(question, texts, images, self.messages, stage=stage)
+        with profiler.span("agent/" + call.stage):
+            generated_ans, messages = self.model.predict(**call.request)
         if add_to_message:
             self.messages = messages
         return generated_ans, messages
@@ -38,13 +54,13 @@ class Agent:
             question = self.config.agent.system_prompt + question
         return self._predict(question, texts, images, add_to_message = True)
     
-    def self_reflect(self, prompt=None, add_to_message = True):
+    def self_reflect(self, prompt=None, add_to_message = True, stage = None):
         if prompt is None:
             self_reflect_prompt = self.config.agent.self_reflect_prompt
         else:
             self_reflect_prompt = prompt
         
-        generated_ans, messages = self._predict(question = self_reflect_prompt)
+        generated_ans, messages = self._predict(question = self_reflect_prompt, stage = stage or self.name + "_reflect")
         if add_to_message:
             self.messages = messages
         
@@ -12,11 +12,35 @@ class MDocAgent(MultiAgentSystem):
     def __init__(self, config):
         super().__init__(config)
     
-    def predict(self, question, texts, images):
+    def predict_flow(self, question, texts, images):
+        general_response, text_reflection, image_reflection = yield from self.general_flow(question, texts, images)
+
+        text_agent = self.agents[1]
+        image_agent = self.agents[0]
+        all_messages = "General Agent:\n" + general_response + "\n"
+        
+        relect_prompt = "\nYou may use the given clue:\n"
+        # The text and image agents only depend on the critical keypoints, so they are yielded together.
+        (text_response, _), (image_response, _) = yield [
+            text_agent.call(question + relect_prompt +text_reflection, texts = texts, images = None, with_sys_prompt=True),
+            image_agent.call(question + relect_prompt +image_reflection, texts = None, images = images, with_sys_prompt=True),
+        ]
+        all_messages += "Text Agent:\n" + text_response + "\n"
+        all_messages += "Image Agent:\n" + image_response + "\n"
+            
+        # print("### Text Agent: " + text_response)
+        # print("### Image Agent: " + image_response)
+        final_ans, final_messages = yield from self.sum_flow(all_messages)
+        # print("### Final Answer: "+final_ans)
+        
+        return final_ans, final_messages
+    
+    def general_flow(self, question, texts, images):
+        """General agent answer and its critical keypoints: (general_response, text_reflection, image_reflection)."""
         general_agent = self.agents[-1]
-        general_response, messages = general_agent.predict(question, texts, images, with_sys_prompt=True)
+        general_response, messages = yield general_agent.call(question, texts, images, with_sys_prompt=True)
         # print("### General Agent: "+ general_response)
-        critical_info = general_agent.self_reflect(prompt = general_agent.config.agent.critical_prompt, add_to_message=False)
+        critical_info, _ = yield general_agent.call(general_agent.config.agent.critical_prompt, history=messages, stage="critical")
         # print("### General Critical Agent: " + critical_info)
 
         start_index = critical_info.find('{') 
@@ -30,20 +54,4 @@ class MDocAgent(MultiAgentSystem):
             image_reflection = critical_info.get("image", "")
         except Exception as e:
             print(e)
-
-        text_agent = self.agents[1]
-        image_agent = self.agents[0]
-        all_messages = "General Agent:\n" + general_response + "\n"
-        
-        relect_prompt = "\nYou may use the given clue:\n"
-        text_response, messages = text_agent.predict(question + relect_prompt +text_reflection, texts = texts, images = None, with_sys_prompt=True)
-        all_messages += "Text Agent:\n" + text_response + "\n"
-        image_response, messages = image_agent.predict(question + relect_prompt +image_reflection, texts = None, images = images, with_sys_prompt=True)
-        all_messages += "Image Agent:\n" + image_response + "\n"
-            
-        # print("### Text Agent: " + text_response)
-        # print("### Image Agent: " + image_response)
-        final_ans, final_messages = self.sum(all_messages)
-        # print("### Final Answer: "+final_ans)
-        
-        return final_ans, final_messages
+        return general_response, text_reflection, image_reflection
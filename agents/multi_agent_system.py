@@ -1,6 +1,10 @@
 from agents.base_agent import Agent
+from agents.scheduler import StageScheduler
 from mydatasets.base_dataset import BaseDataset
+from utils.profiler import profiler
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 import importlib
 import json
 import torch
@@ -33,11 +37,61 @@ class MultiAgentSystem:
         self.agents.append(agent)
         
     def predict(self, question, texts, images):
-        '''Implement the method in the subclass'''
-        pass
+        return self.run_flow(self.predict_flow(question, texts, images))
+    
+    def predict_flow(self, question, texts, images):
+        '''Implement the method in the subclass: a generator that yields AgentCall (or a list of independent ones) and returns (final_ans, final_messages)'''
+        raise NotImplementedError
+    
+    def run_flow(self, flow):
+        """Answer the calls of one flow in order. Lists of independent calls run concurrently with concurrent_agents."""
+        result = None
+        while True:
+            try:
+                calls = flow.send(result)
+            except StopIteration as e:
+                return e.value
+            if not isinstance(calls, list):
+                result = self.run_calls([calls])[0]
+            elif self.config.concurrent_agents:
+                result = self.run_concurrent(calls)
+            else:
+                result = self.run_calls(calls)
+    
+    def run_calls(self, calls):
+        results = []
+        for call in calls:
+            with profiler.span("agent/" + call.stage):
+                results.append(call.agent.model.predict(**call.request))
+        return results
+    
+    def run_concurrent(self, calls):
+        """
+        Send the calls of each model as one predict_batch: API models answer them from a thread pool, local models
+        generate them in one batch. Groups of different models run in parallel threads.
+        The span of a group is named after all its stages, e.g. agent/text+image.
+        """
+        groups = {}
+        for slot, call in enumerate(calls):
+            groups.setdefault(id(call.agent.model), []).append(slot)
+        def run_group(slots):
+            stage = "+".join(dict.fromkeys(calls[slot].stage for slot in slots))
+            with profiler.span("agent/" + stage):
+                return calls[slots[0]].agent.model.predict_batch([calls[slot].request for slot in slots])
+        results = [None] * len(calls)
+        # Each thread copies the context, so its spans keep the current sample.
+        with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+            futures = [(slots, executor.submit(contextvars.copy_context().run, run_group, slots)) for slots in groups.values()]
+            for slots, future in futures:
+                for slot, answer in zip(slots, future.result()):
+                    results[slot] = answer
+        return results
     
     def sum(self, sum_question):
-        ans, all_messages = self.sum_agent.predict(sum_question)
+        return self.run_flow(self.sum_flow(sum_question))
+    
+    def sum_flow(self, sum_question):
+        ans, all_messages = yield self.sum_agent.call(sum_question, with_sys_prompt=True)
         def extract_final_answer(agent_response):
             try:
                 response_dict = json.loads(agent_response)
@@ -50,37 +104,88 @@ class MultiAgentSystem:
 
     def predict_dataset(self, dataset:BaseDataset, resume_path = None):
         samples = dataset.load_data(use_retreival=True)
-        if resume_path:
+        if self.config.resume and resume_path is None:
+            resume_path = dataset.find_latest_journal()
+            print(f"Resume from {resume_path}.")
+        resume_from_journal = resume_path is not None and resume_path.endswith(".jsonl")
+        if resume_path and not resume_from_journal:
             assert os.path.exists(resume_path)
             with open(resume_path, 'r') as f:
                 samples = json.load(f)
         if self.config.truncate_len:
             samples = samples[:self.config.truncate_len]
+        
+        finished = set()
+        if resume_from_journal:
+            finished = dataset.load_journal(samples, resume_path)
+        # Samples not retrieved yet are sent to the retrieval server (if configured) in batches up front.
+        num_retrieved = dataset.retrieve_missing([sample for index, sample in enumerate(samples) if index not in finished])
+        if num_retrieved:
+            print(f"Retrieved {num_retrieved} samples on {dataset.config.retrieval_server}.")
+        journal = None
+        if self.config.use_journal:
+            journal = dataset.open_result_journal(resume_path if resume_from_journal else None)
+            print(f"Write results to journal {journal.path}.")
             
+        indices = [index for index in dataset.document_order(samples)
+                   if not (index in finished or (resume_path and not resume_from_journal and self.config.ans_key in samples[index]))]
+        if self.config.batch_samples > 1:
+            outcomes = self.predict_scheduled(dataset, samples, indices)
+        else:
+            outcomes = self.predict_samples(dataset, samples, indices)
         sample_no = 0
-        for sample in tqdm(samples):
-            if resume_path and self.config.ans_key in sample:
-                continue
-            question, texts, images = dataset.load_sample_retrieval_data(sample)
-            try:
-                final_ans, final_messages = self.predict(question, texts, images)
-            except RuntimeError as e:
-                print(e)
-                if "out of memory" in str(e):
-                    torch.cuda.empty_cache()
-                final_ans, final_messages = None, None
-            sample[self.config.ans_key] = final_ans
+        for index, final_ans, final_messages in tqdm(outcomes, total=len(indices)):
+            sample = samples[index]
+            result = {self.config.ans_key: final_ans}
             if self.config.save_message:
-                sample[self.config.ans_key+"_message"] = final_messages
+                result[self.config.ans_key+"_message"] = final_messages
+            sample.update(result)
             torch.cuda.empty_cache()
             self.clean_messages()
             
             sample_no += 1
-            if sample_no % self.config.save_freq == 0:
+            if journal is not None:
+                journal.append(index, result)
+            elif sample_no % self.config.save_freq == 0:
                 path = dataset.dump_reults(samples)
                 print(f"Save {sample_no} results to {path}.")
+            if dataset.config.profile_dir and sample_no % self.config.save_freq == 0:
+                profiler.export_prometheus(os.path.join(dataset.config.profile_dir, "metrics.prom"))
+        if journal is not None:
+            journal.close()
+        # The final json has the same layout with or without the journal.
         path = dataset.dump_reults(samples)
         print(f"Save final results to {path}.")
+        print(f"Content cache: {dataset.content_cache.stats()}")
+        if dataset.config.profile_dir:
+            path = profiler.export(dataset.config.profile_dir, prefix=dataset.time)
+            print(f"Save profile to {path}.")
+    
+    def predict_samples(self, dataset:BaseDataset, samples, indices):
+        for index in indices:
+            with profiler.sample(index):
+                question, texts, images = dataset.load_sample_retrieval_data(samples[index])
+                try:
+                    final_ans, final_messages = self.predict(question, texts, images)
+                except RuntimeError as e:
+                    final_ans, final_messages = self.failed(e)
+            yield index, final_ans, final_messages
+    
+    def predict_scheduled(self, dataset:BaseDataset, samples, indices):
+        """Advance up to batch_samples samples together; samples come out as they finish, not in order."""
+        def flows():
+            for index in indices:
+                with profiler.sample(index):
+                    question, texts, images = dataset.load_sample_retrieval_data(samples[index])
+                yield index, self.predict_flow(question, texts, images)
+        for index, result, error in StageScheduler(self.config.batch_samples).run(flows()):
+            yield (index, *(self.failed(error) if error is not None else result))
+    
+    def failed(self, error):
+        print(error)
+        if "out of memory" in str(error):
+            torch.cuda.empty_cache()
+        return None, None
     
     def clean_messages(self):
         for agent in self.agents:
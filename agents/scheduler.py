@@ -0,0 +1,107 @@
+from utils.profiler import profiler
+
+PENDING = object()
+
+class StageScheduler():
+    """
+    Runs the agent flows of many samples together. A flow is a generator that yields one AgentCall (or a list of
+    independent calls) at a time and receives its (answer, messages) (or a list of them). At every step the pending
+    calls of the same stage and model are answered with one model.predict_batch, the largest group first. Each flow
+    gets the same answers in the same order as when run alone, so the results equal the sequential path.
+    """
+    def __init__(self, max_flows):
+        self.max_flows = max_flows
+
+    def run(self, flows):
+        """
+        :param flows: Iterable of (key, flow); it is read lazily, at most max_flows flows are open at a time.
+        :return: Generator of (key, result, error) as flows finish. error is the RuntimeError that ended the flow, or None.
+        """
+        flows = iter(flows)
+        active = []
+        exhausted = False
+        while active or not exhausted:
+            while not exhausted and len(active) < self.max_flows:
+                try:
+                    key, flow = next(flows)
+                except StopIteration:
+                    exhausted = True
+                    break
+                entry = FlowState(key, flow)
+                active.append(entry)
+                yield from self.advance(active, entry, None)
+            if not active:
+                continue
+            group = self.next_group(active)
+            for (entry, slot), result in zip(group, self.answer([entry.calls[slot] for entry, slot in group])):
+                entry.results[slot] = result
+            for entry in dict.fromkeys(entry for entry, _ in group):
+                if PENDING not in entry.results:
+                    yield from self.advance(active, entry, entry.result())
+
+    def advance(self, active, entry, result):
+        """Send a result (or throw an error) into a flow and store its next calls; finished flows leave active."""
+        try:
+            entry.wait(entry.flow.throw(result) if isinstance(result, RuntimeError) else entry.flow.send(result))
+            return
+        except StopIteration as e:
+            outcome = (entry.key, e.value, None)
+        except RuntimeError as e:
+            outcome = (entry.key, None, e)
+        active.remove(entry)
+        yield outcome
+
+    def next_group(self, active):
+        """:return: (entry, slot) of every pending call in the chosen group."""
+        groups = {}
+        for entry in active:
+            for slot, call in enumerate(entry.calls):
+                if entry.results[slot] is PENDING:
+                    groups.setdefault((call.stage, id(call.agent.model)), []).append((entry, slot))
+        # max keeps the first of equal groups, i.e. the one with the oldest flow.
+        return max(groups.values(), key=len)
+
+    def answer(self, calls):
+        """:return: (answer, messages) per call, or the RuntimeError of a call that failed on its own."""
+        model = calls[0].agent.model
+        stage = "agent/" + calls[0].stage
+        try:
+            with profiler.span(stage):
+                # Models append to the history in place; copies keep it intact for the retry below.
+                return model.predict_batch([dict(call.request, history=copy_history(call.request["history"])) for call in calls])
+        except RuntimeError as e:
+            if len(calls) == 1:
+                return [e]
+            print(f"Batch of {len(calls)} {stage} calls failed ({e}); retrying one by one.")
+        results = []
+        for call in calls:
+            try:
+                with profiler.span(stage):
+                    results.append(model.predict(**call.request))
+            except RuntimeError as e:
+                results.append(e)
+        return results
+
+class FlowState():
+    """A running flow with the calls it waits on and the results received so far."""
+    def __init__(self, key, flow):
+        self.key = key
+        self.flow = flow
+        self.single = True
+        self.calls = []
+        self.results = []
+
+    def wait(self, calls):
+        self.single = not isinstance(calls, list)
+        self.calls = [calls] if self.single else calls
+        self.results = [PENDING] * len(self.calls)
+
+    def result(self):
+        """What the flow receives: the first error of its calls, else one result or the list of them."""
+        for result in self.results:
+            if isinstance(result, RuntimeError):
+                return result
+        return self.results[0] if self.single else list(self.results)
+
+def copy_history(history):
+    return None if history is None else list(history)
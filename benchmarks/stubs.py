@@ -0,0 +1,179 @@
+import functools
+import json
+import os
+import re
+import time
+import zlib
+import torch
+
+from models.base_model import BaseModel
+from retrieval.corpus_retrieval import CorpusRetrieval
+from retrieval.image_retrieval import ColpaliRetrieval
+from retrieval.text_retrieval import ColbertRetrieval
+from utils.profiler import profile_stage, record
+
+def tokenize(text):
+    return re.findall(r"\w+", text.lower())
+
+class StubModel(BaseModel):
+    """
+    Generation model with a fixed per-call latency (config.latency, in seconds); predict_batch pays it once per
+    config.batch_size conversations. The answer is valid json for both the critical agent ({"text", "image"})
+    and the sum agent ({"Answer"}).
+    """
+    def __init__(self, config):
+        super().__init__(config)
+        self.create_ask_message = lambda question: {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": question},
+            ],
+        }
+        self.create_ans_message = lambda ans: {
+            "role": "assistant",
+            "content": [
+                {"type": "text", "text": ans},
+            ],
+        }
+
+    def create_text_message(self, texts, question):
+        content = [{"type": "text", "text": text} for text in texts]
+        content.append({"type": "text", "text": question})
+        return {"role": "user", "content": content}
+
+    def create_image_message(self, images, question):
+        content = [{"type": "image", "image": image_path} for image_path in images]
+        content.append({"type": "text", "text": question})
+        return {"role": "user", "content": content}
+
+    @profile_stage("model")
+    def predict(self, question, texts = None, images = None, history = None):
+        time.sleep(self.config.latency)
+        return self.answer(question, texts, images, history)
+
+    @profile_stage("model")
+    def predict_batch(self, requests):
+        results = []
+        for start in range(0, len(requests), self.config.batch_size):
+            time.sleep(self.config.latency)
+            results.extend(self.answer(**request) for request in requests[start:start + self.config.batch_size])
+        return results
+
+    def answer(self, question, texts = None, images = None, history = None):
+        messages = self.process_message(question, texts, images, history)
+        answer = json.dumps({"text": "stub", "image": "stub", "Answer": " ".join(tokenize(question)[-4:])})
+        prompt_tokens = sum(len(tokenize(item["text"])) for message in messages for item in message["content"] if item["type"] == "text")
+        record(prompt_tokens=prompt_tokens, generated_tokens=len(tokenize(answer)), images=len(images or []))
+        messages.append(self.create_ans_message(answer))
+        return answer, messages
+
+class TinyColpaliModel(torch.nn.Module):
+    """
+    A few-kilobyte multi-vector encoder with ColPali's output shape: every page becomes patches x patches
+    normalized vectors, every query one normalized vector per word.
+    """
+    def __init__(self, dim=32, patches=8, patch_size=8, vocab_size=4096, seed=0):
+        super().__init__()
+        generator = torch.Generator().manual_seed(seed)
+        self.patches = patches
+        self.patch_size = patch_size
+        self.vocab_size = vocab_size
+        self.patch_proj = torch.nn.Parameter(torch.randn(patch_size * patch_size, dim, generator=generator))
+        self.word_embed = torch.nn.Parameter(torch.randn(vocab_size, dim, generator=generator))
+
+    @property
+    def device(self):
+        return self.patch_proj.device
+
+    def preprocess(self, images):
+        return preprocess_pages(images, self.patches * self.patch_size)
+
+    def encode_images(self, pixels):
+        patches = pixels.unfold(1, self.patch_size, self.patch_size).unfold(2, self.patch_size, self.patch_size)
+        patches = patches.reshape(len(pixels), self.patches * self.patches, -1)
+        return torch.nn.functional.normalize(patches @ self.patch_proj, dim=-1).half()
+
+    def encode_queries(self, queries):
+        ids = [[zlib.crc32(word.encode()) % self.vocab_size for word in tokenize(query)] or [0] for query in queries]
+        length = max(len(row) for row in ids)
+        embeds = torch.zeros(len(queries), length, self.word_embed.shape[1])
+        for row, word_ids in enumerate(ids):
+            embeds[row, :len(word_ids)] = torch.nn.functional.normalize(self.word_embed[word_ids], dim=-1)
+        return embeds.half()
+
+def preprocess_pages(images, side):
+    return torch.stack([
+        torch.frombuffer(bytearray(image.convert("L").resize((side, side)).tobytes()), dtype=torch.uint8).float().view(side, side) / 255.0
+        for image in images
+    ])
+
+class TinyColpaliRetrieval(ColpaliRetrieval):
+    def __init__(self, config):
+        self.config = config
+        self.model = TinyColpaliModel().eval()
+        self.processor = None
+
+    def page_preprocessor(self):
+        return functools.partial(preprocess_pages, side=self.model.patches * self.model.patch_size)
+
+    @torch.no_grad()
+    def embed_batch(self, batch_inputs):
+        return self.model.encode_images(batch_inputs)
+
+    @torch.no_grad()
+    def embed_queries(self, queries):
+        return self.model.encode_queries(queries)
+
+class TinyCorpusRetrieval(TinyColpaliRetrieval, CorpusRetrieval):
+    pass
+
+class TinyRAG():
+    """
+    In-process stand-in for RAGPretrainedModel with bag-of-words scoring. Indexes use the same on-disk
+    layout that ColbertRetrieval reads (<index>/pid_docid_map.json).
+    """
+    def __init__(self, index_root, index_path=None):
+        self.index_root = index_root
+        self.collection = []
+        self.document_ids = []
+        if index_path is not None:
+            with open(os.path.join(index_path, "collection.json"), "r") as f:
+                self.collection = [set(tokenize(text)) for text in json.load(f)]
+            with open(os.path.join(index_path, "pid_docid_map.json"), "r") as f:
+                self.document_ids = [document_id for _, document_id in sorted(json.load(f).items(), key=lambda item: int(item[0]))]
+
+    @classmethod
+    def from_index(cls, index_path):
+        return cls(os.path.dirname(index_path), index_path)
+
+    def index(self, index_name, collection, document_ids=None, **kwargs):
+        index_path = os.path.join(self.index_root, index_name)
+        os.makedirs(index_path, exist_ok=True)
+        if document_ids is None:
+            document_ids = [f"page-{pid}" for pid in range(len(collection))]
+        with open(os.path.join(index_path, "collection.json"), "w") as f:
+            json.dump(collection, f)
+        with open(os.path.join(index_path, "pid_docid_map.json"), "w") as f:
+            json.dump({str(pid): document_id for pid, document_id in enumerate(document_ids)}, f)
+        return index_path
+
+    def search(self, query, k=10, doc_ids=None, **kwargs):
+        words = set(tokenize(query))
+        pids = range(len(self.collection))
+        if doc_ids is not None:
+            doc_ids = set(doc_ids)
+            pids = [pid for pid in pids if self.document_ids[pid] in doc_ids]
+        scores = [(len(words & self.collection[pid]) / (1 + len(self.collection[pid])) ** 0.5, pid) for pid in pids]
+        scores.sort(key=lambda item: (-item[0], item[1]))
+        return [{"passage_id": pid, "score": score, "rank": rank + 1} for rank, (score, pid) in enumerate(scores[:k])]
+
+class TinyColbertRetrieval(ColbertRetrieval):
+    def __init__(self, config, index_root):
+        super().__init__(config)
+        self.index_root = index_root
+
+    def load_model(self):
+        return TinyRAG(self.index_root)
+
+    def load_searcher(self, index_path):
+        return TinyRAG.from_index(index_path)
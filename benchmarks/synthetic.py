@@ -0,0 +1,41 @@
+import json
+import os
+import random
+import pymupdf
+
+WORDS = ("revenue margin table figure chart policy budget growth market report quarter annual "
+         "survey model training dataset accuracy method result analysis section summary appendix "
+         "customer product region forecast risk audit energy climate health education transport").split()
+
+def make_corpus(root, num_docs=8, pages_per_doc=24, questions_per_doc=4, lines_per_page=30, seed=0):
+    """
+    Write synthetic multi-page PDFs to <root>/documents and questions to <root>/samples.json.
+    Every page carries a unique keyword, and each question asks about one page's keyword so that
+    retrieval has a known answer page.
+    :return: Path of the samples file and the total number of pages.
+    """
+    rng = random.Random(seed)
+    document_dir = os.path.join(root, "documents")
+    os.makedirs(document_dir, exist_ok=True)
+    samples = []
+    for doc_no in range(num_docs):
+        doc_id = f"synthetic-{doc_no}.pdf"
+        keywords = [f"kw{doc_no}x{page_no}" for page_no in range(pages_per_doc)]
+        with pymupdf.open() as pdf:
+            for page_no in range(pages_per_doc):
+                page = pdf.new_page()
+                lines = [" ".join(rng.choice(WORDS) for _ in range(10)) for _ in range(lines_per_page)]
+                lines.insert(rng.randrange(len(lines)), f"The {keywords[page_no]} value is {rng.randint(0, 999)}.")
+                page.insert_text((48, 48), "\n".join(lines), fontsize=9)
+            pdf.save(os.path.join(document_dir, doc_id))
+        for page_no in rng.sample(range(pages_per_doc), min(questions_per_doc, pages_per_doc)):
+            samples.append({
+                "doc_id": doc_id,
+                "question": f"What is the {keywords[page_no]} value?",
+                "answer": "",
+                "answer_page": page_no,
+            })
+    sample_path = os.path.join(root, "samples.json")
+    with open(sample_path, "w") as f:
+        json.dump(samples, f, indent=4)
+    return sample_path, num_docs * pages_per_doc
@@ -1,4 +1,5 @@
 import torch
+from utils.profiler import profile_stage, record
 class BaseModel():
     def __init__(self, config):
         """
@@ -10,6 +11,14 @@ class BaseModel():
     def predict(self, question, texts = None, images = None, history = None):
         pass
     
+    def predict_batch(self, requests):
+        """
+        Answer several independent conversations. Models that can generate them together override this loop.
+        :param requests: One dict of predict keyword arguments (question, texts, images, history) per conversation.
+        :return: One (answer, messages) pair per request, in order.
+        """
+        return [self.predict(**request) for request in requests]
+    
     def clean_up(self):
         torch.cuda.empty_cache()
         
@@ -31,4 +40,43 @@ class BaseModel():
         return messages
     
     def is_valid_history(self, history):
-        return True
\ No newline at end of file
+        return True
+
+class PipelineModel(BaseModel):
+    """
+    Base of models that generate through a transformers text-generation pipeline in self.pipeline.
+    Subclasses set up the pipeline and the message builders.
+    """
+    @torch.no_grad()
+    @profile_stage("model")
+    def predict_batch(self, requests):
+        self.clean_up()
+        all_messages = [self.process_message(**request) for request in requests]
+        tokenizer = self.pipeline.tokenizer
+        # Batched generation pads the prompts on the left; models without a pad token reuse eos.
+        # The tokenizer is shared with predict, so both settings are restored afterwards.
+        pad_token_id, padding_side = tokenizer.pad_token_id, tokenizer.padding_side
+        if pad_token_id is None:
+            tokenizer.pad_token_id = tokenizer.eos_token_id
+        tokenizer.padding_side = "left"
+        try:
+            outputs = self.pipeline(
+                all_messages,
+                batch_size=self.config.batch_size,
+                max_new_tokens=self.config.max_new_tokens,
+                pad_token_id=tokenizer.pad_token_id,
+            )
+        finally:
+            tokenizer.pad_token_id = pad_token_id
+            tokenizer.padding_side = padding_side
+        self.clean_up()
+        results = []
+        for messages, output in zip(all_messages, outputs):
+            record(**self.count_tokens(messages, output[0]["generated_text"][-1]['content']))
+            results.append((output[0]["generated_text"][-1]['content'], output[0]["generated_text"]))
+        return results
+    
+    def count_tokens(self, messages, answer):
+        tokenizer = self.pipeline.tokenizer
+        prompt_tokens = sum(len(tokenizer.encode(message["content"])) for message in messages)
+        return {"prompt_tokens": prompt_tokens, "generated_tokens": len(tokenizer.encode(answer))}
\ No newline at end of file
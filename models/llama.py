@@ -1,8 +1,9 @@
-from models.base_model import BaseModel
+from models.base_model import PipelineModel
 import torch
 import transformers
+from utils.profiler import profile_stage, record
 
-class Llama3(BaseModel):
+class Llama3(PipelineModel):
     def __init__(self, config):
         super().__init__(config)
         
@@ -32,6 +33,7 @@ class Llama3(BaseModel):
         return message
     
     @torch.no_grad()
+    @profile_stage("model")
     def predict(self, question, texts = None, images = None, history = None):
         self.clean_up()
         messages = self.process_message(question, texts, images, history)
@@ -41,8 +43,9 @@ class Llama3(BaseModel):
             pad_token_id=self.pipeline.tokenizer.eos_token_id,
         )
         self.clean_up()
+        record(**self.count_tokens(messages, outputs[0]["generated_text"][-1]['content']))
         return outputs[0]["generated_text"][-1]['content'], outputs[0]["generated_text"]
-        
+    
     def is_valid_history(self, history):
         if not isinstance(history, list):
             return False
@@ -1,10 +1,13 @@
 from models.base_model import BaseModel
+from mydatasets.page_store import read_image_bytes
+from utils.profiler import profile_stage, record
 from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor
 import base64
+import contextvars
 
 def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+    return base64.b64encode(read_image_bytes(image_path)).decode("utf-8")
 
 class MyOpenAI(BaseModel):
     def __init__(self, config):
@@ -48,6 +51,7 @@ class MyOpenAI(BaseModel):
         }
         return message
     
+    @profile_stage("model")
     def predict(self, question, texts = None, images = None, history = None):
         messages = self.process_message(question, texts, images, history)
         response = self.client.chat.completions.create(
@@ -57,9 +61,18 @@ class MyOpenAI(BaseModel):
             max_tokens=self.config.max_new_tokens,
         )
         result = response.choices[0].message.content
+        if response.usage is not None:
+            record(prompt_tokens=response.usage.prompt_tokens, generated_tokens=response.usage.completion_tokens)
+        record(images=len(images or []))
         messages.append(self.create_ans_message(result))
         return result, messages
     
+    def predict_batch(self, requests):
+        # Requests are sent from up to batch_size threads; each copies the context so its spans keep the sample.
+        with ThreadPoolExecutor(max_workers=self.config.batch_size) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, self.predict, **request) for request in requests]
+            return [future.result() for future in futures]
+    
     def is_valid_history(self, history):
         if not isinstance(history, list):
             return False
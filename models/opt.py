@@ -1,8 +1,9 @@
-from models.base_model import BaseModel
+from models.base_model import PipelineModel
 import torch
 import transformers
+from utils.profiler import profile_stage, record
 
-class OPT(BaseModel):
+class OPT(PipelineModel):
     def __init__(self, config):
         super().__init__(config)
         
@@ -35,6 +36,7 @@ class OPT(BaseModel):
         return message
     
     @torch.no_grad()
+    @profile_stage("model")
     def predict(self, question, texts = None, images = None, history = None):
         self.clean_up()
         messages = self.process_message(question, texts, images, history)
@@ -44,8 +46,9 @@ class OPT(BaseModel):
             pad_token_id=self.pipeline.tokenizer.eos_token_id,
         )
         self.clean_up()
+        record(**self.count_tokens(messages, outputs[0]["generated_text"][-1]['content']))
         return outputs[0]["generated_text"][-1]['content'], outputs[0]["generated_text"]
-        
+    
     def is_valid_history(self, history):
         if not isinstance(history, list):
             return False
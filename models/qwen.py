@@ -1,6 +1,8 @@
 from models.base_model import BaseModel
 from transformers import Qwen2VLForConditionalGeneration, AutoProcessor, Qwen2_5_VLForConditionalGeneration, AutoTokenizer
 from qwen_vl_utils import process_vision_info
+from mydatasets.page_store import resolve_image
+from utils.profiler import profile_stage, record
 import torch
 
 class Qwen2VL(BaseModel):
@@ -47,13 +49,14 @@ class Qwen2VL(BaseModel):
         return message
     
     @torch.no_grad()
+    @profile_stage("model")
     def predict(self, question, texts = None, images = None, history = None):
         self.clean_up()
         messages = self.process_message(question, texts, images, history)
         text = self.processor.apply_chat_template(
             messages, tokenize=False, add_generation_prompt=True
         )
-        image_inputs, video_inputs = process_vision_info(messages)
+        image_inputs, video_inputs = process_vision_info(self.resolve_images(messages))
         inputs = self.processor(
             text=[text],
             images=image_inputs,
@@ -70,9 +73,68 @@ class Qwen2VL(BaseModel):
         output_text = self.processor.batch_decode(
             generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
         )[0]
+        record(prompt_tokens=inputs.input_ids.shape[1], generated_tokens=len(generated_ids_trimmed[0]), images=len(image_inputs or []))
         messages.append(self.create_ans_message(output_text))
         self.clean_up()
         return output_text, messages
+    
+    @torch.no_grad()
+    @profile_stage("model")
+    def predict_batch(self, requests):
+        self.clean_up()
+        results = []
+        for start in range(0, len(requests), self.config.batch_size):
+            results.extend(self.generate_batch(requests[start:start + self.config.batch_size]))
+            self.clean_up()
+        return results
+    
+    def generate_batch(self, requests):
+        """
+        Generate several conversations in one model.generate call. Prompts are left-padded, so every row ends at the
+        same position and its answer starts right after the shared prompt length.
+        """
+        all_messages = [self.process_message(**request) for request in requests]
+        texts = [self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True) for messages in all_messages]
+        # Images of all rows in order; the processor assigns them to the image tokens of each row in turn.
+        image_inputs, video_inputs = process_vision_info([self.resolve_images(messages) for messages in all_messages])
+        tokenizer = self.processor.tokenizer
+        padding_side = tokenizer.padding_side
+        tokenizer.padding_side = "left"
+        try:
+            inputs = self.processor(
+                text=texts,
+                images=image_inputs,
+                videos=video_inputs,
+                padding=True,
+                return_tensors="pt",
+            )
+        finally:
+            tokenizer.padding_side = padding_side
+        inputs = inputs.to("cpu")
+        
+        generated_ids = self.model.generate(**inputs, max_new_tokens=self.config.max_new_tokens)
+        generated_ids_trimmed = generated_ids[:, inputs.input_ids.shape[1]:]
+        output_texts = self.processor.batch_decode(
+            generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
+        )
+        # Rows that finished early are padded after their answer.
+        generated_tokens = (generated_ids_trimmed != tokenizer.pad_token_id).sum().item()
+        record(prompt_tokens=inputs.attention_mask.sum().item(), generated_tokens=generated_tokens, images=len(image_inputs or []))
+        results = []
+        for messages, output_text in zip(all_messages, output_texts):
+            messages.append(self.create_ans_message(output_text))
+            results.append((output_text, messages))
+        return results
+        
+    def resolve_images(self, messages):
+        # Packed page references are opened here so that the stored messages keep plain strings.
+        resolved = []
+        for message in messages:
+            content = message["content"]
+            if isinstance(content, list):
+                content = [dict(item, image=resolve_image(item["image"])) if item.get("type") == "image" else item for item in content]
+            resolved.append(dict(message, content=content))
+        return resolved
         
     def is_valid_history(self, history):
         if not isinstance(history, list):
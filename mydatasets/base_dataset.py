@@ -1,29 +1,115 @@
+import hashlib
 import json
 import re
+import copy
 from dataclasses import dataclass
+from collections.abc import Sequence
 from PIL import Image
 import os
 import pymupdf
 from tqdm import tqdm
 from datetime import datetime
 import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from mydatasets import page_store
+from mydatasets.result_journal import JOURNAL_SUFFIX, ResultJournal, read_journal, apply_journal
+from mydatasets.ranking_store import RankingStore
+from retrieval.client import RetrievalClient
+from utils.lru_cache import LRUCache
+from utils.profiler import profile_stage, record
 
 @dataclass
 class Content:
     image: Image
     image_path: str
     txt: str
+
+class DocumentContent(Sequence):
+    """
+    Pages of one extracted document. Texts and images are only read when a page is accessed,
+    so callers that use a few retrieved pages do not pay for the whole document.
+    """
+    def __init__(self, dataset, doc_name, num_pages, packed_path=None, manifest=None, with_image=False):
+        self.dataset = dataset
+        self.doc_name = doc_name
+        self.num_pages = num_pages
+        self.packed_path = packed_path
+        self.manifest = manifest
+        self.with_image = with_image
+        self._texts = {}
+        self.on_load = None # Called after a text is loaded, so a cache holding the document can re-measure it
+    
+    def __len__(self):
+        return self.num_pages
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.num_pages))]
+        if index < 0:
+            index += self.num_pages
+        if not 0 <= index < self.num_pages:
+            raise IndexError(f"Page {index} out of range for {self.doc_name} ({self.num_pages} pages)")
+        image = self.image(index) if self.with_image else None
+        return Content(image=image, image_path=self.image_path(index), txt=self.txt(index))
+    
+    @property
+    def nbytes(self):
+        return sum(len(txt) for txt in self._texts.values())
+    
+    def view(self, with_image):
+        """Same document with a different image loading mode; loaded texts are shared."""
+        if with_image == self.with_image:
+            return self
+        content = copy.copy(self)
+        content.with_image = with_image
+        return content
+    
+    @property
+    def fingerprint(self):
+        """Hash of the extracted page set; it changes when the document is re-extracted with different pages."""
+        if self.manifest is not None:
+            state = [self.num_pages, self.manifest["format"], self.manifest["pages"][:self.num_pages]]
+        elif self.packed_path is not None:
+            stat = os.stat(self.packed_path)
+            state = [self.num_pages, stat.st_size, stat.st_mtime_ns]
+        else:
+            stats = [os.stat(self.dataset.IM_FILE(self.doc_name, i)) for i in range(self.num_pages)]
+            state = [self.num_pages] + [[stat.st_size, stat.st_mtime_ns] for stat in stats]
+        return hashlib.sha1(json.dumps(state).encode("utf-8")).hexdigest()
+    
+    def image_path(self, index):
+        if self.packed_path is not None:
+            return page_store.packed_ref(self.packed_path, index)
+        return self.dataset.IM_FILE(self.doc_name, index)
+    
+    def image(self, index):
+        return self.dataset.load_image(self.image_path(index))
+    
+    def txt(self, index):
+        if index not in self._texts:
+            if self.packed_path is not None:
+                data = page_store.open_packed(self.packed_path).read_text_bytes(index)
+                self._texts[index] = self.dataset.decode_txt(data)
+            else:
+                self._texts[index] = self.dataset.load_txt(self.dataset.TEXT_FILE(self.doc_name, index))
+            if self.on_load is not None:
+                self.on_load()
+        return self._texts[index]
     
 class BaseDataset():
     def __init__(self, config):
         self.config = config
-        self.IM_FILE = lambda doc_name,index: f"{self.config.extract_path}/{doc_name}_{index}.png"
-        self.TEXT_FILE = lambda doc_name,index: f"{self.config.extract_path}/{doc_name}_{index}.txt"
+        self.IM_FILE = lambda doc_name,index: im_file(self.config.extract_path, doc_name, index)
+        self.TEXT_FILE = lambda doc_name,index: text_file(self.config.extract_path, doc_name, index)
+        self.MANIFEST_FILE = lambda doc_name: manifest_file(self.config.extract_path, doc_name)
         self.EXTRACT_DOCUMENT_ID = lambda sample: re.sub("\\.pdf$", "", sample["doc_id"]).split("/")[-1] 
         current_time = datetime.now()
         self.time = current_time.strftime("%Y-%m-%d-%H-%M")
+        self.content_cache = LRUCache(max_bytes=int(self.config.content_cache_mb * 1024 * 1024), sizeof=lambda content: content.nbytes)
+        self.rankings = RankingStore(self.config.ranking_path) if self.config.get("ranking_path") else None
+        self.retrieval_client = RetrievalClient(self.config.retrieval_server) if self.config.get("retrieval_server") else None
     
-    def load_data(self, use_retreival=True):
+    def data_path(self, use_retreival=True):
         path = self.config.sample_path
         if use_retreival:
             try:
@@ -33,20 +119,44 @@ class BaseDataset():
                 print("Use original sample path!")
                 
         assert(os.path.exists(path))
-        with open(path, 'r') as f:
-            samples = json.load(f)
+        return path
+    
+    def load_data(self, use_retreival=True):
+        samples = list(self.iter_data(self.data_path(use_retreival)))
             
         return samples
     
+    def iter_samples(self, use_retreival=True):
+        """Samples one at a time, for callers that read them once and do not write them back; .jsonl files are never held in memory."""
+        return self.iter_data(self.data_path(use_retreival))
+    
+    def iter_data(self, path):
+        # .jsonl sample files hold one sample per line and are parsed one line at a time.
+        with open(path, 'r') as f:
+            if not path.endswith(".jsonl"):
+                yield from json.load(f)
+                return
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    
     def dump_data(self, samples, use_retreival=True):
         if use_retreival:
+            # Rankings referenced by the samples are committed before the samples are written.
+            if self.rankings is not None:
+                self.rankings.flush()
             path = self.config.sample_with_retrieval_path
         else:
             path = self.config.sample_path
 
         os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'w') as f:
-            json.dump(samples, f, indent = 4)
+        with open(path + ".tmp", 'w') as f:
+            if path.endswith(".jsonl"):
+                for sample in samples:
+                    f.write(json.dumps(sample) + "\n")
+            else:
+                json.dump(samples, f, indent = 4)
+        os.replace(path + ".tmp", path)
         
         return path
     
@@ -64,43 +174,103 @@ class BaseDataset():
             json.dump(samples, f, indent = 4)
         return path
     
+    def open_result_journal(self, path=None):
+        if path is None:
+            path = os.path.join(self.config.result_dir, self.time + JOURNAL_SUFFIX)
+        return ResultJournal(path)
+    
+    def find_latest_journal(self):
+        pattern = os.path.join(self.config.result_dir, "*-*-*-*-*" + JOURNAL_SUFFIX)
+        files = glob.glob(pattern)
+        if not files:
+            return None
+        return max(files, key=lambda f: datetime.strptime(os.path.basename(f)[:-len(JOURNAL_SUFFIX)], "%Y-%m-%d-%H-%M"))
+    
+    def load_journal(self, samples, journal_path):
+        results = read_journal(journal_path)
+        apply_journal(samples, results)
+        return set(results.keys())
+    
+    def compact_results(self, journal_path, samples=None):
+        """Merge a result journal into the samples and write the usual final result json."""
+        if samples is None:
+            samples = self.load_data(use_retreival=True)
+        self.load_journal(samples, journal_path)
+        return self.dump_reults(samples)
+    
     def load_retrieval_data(self):
         assert(os.path.exists(self.config.sample_with_retrieval_path))
-        with open(self.config.sample_with_retrieval_path, 'r') as f:
-            samples = json.load(f)
-        for sample in tqdm(samples):
+        samples = list(self.iter_data(self.config.sample_with_retrieval_path))
+        self.retrieve_missing(samples)
+        for sample in tqdm(self.iter_by_document(samples), total=len(samples)):
             _, sample["texts"], sample["images"] = self.load_sample_retrieval_data(sample)
         return samples
     
+    def retrieve_missing(self, samples):
+        """
+        Retrieve samples lacking any result key used at inference (text and image, plus mix with use_mix) on
+        dataset.retrieval_server, in batches, updating them in place. Call it once for all samples before the loop.
+        Keys that none of the server's retrievers write are not waited for.
+        :return: Number of samples retrieved.
+        """
+        if self.retrieval_client is None:
+            return 0
+        keys = [self.config.r_text_key, self.config.r_image_key] + ([self.config.r_mix_key] if self.config.use_mix else [])
+        served = self.retrieval_client.result_keys()
+        unserved = [key for key in keys if key not in served]
+        if unserved:
+            print(f"Retrieval server does not write {unserved}; add the retrievals to retrieval_server.retrievals to fill them.")
+        keys = [key for key in keys if key in served]
+        missing = [sample for sample in samples if any(key not in sample for key in keys)]
+        if missing:
+            self.retrieval_client.retrieve(missing)
+        return len(missing)
+    
+    @profile_stage("data", name="load_sample_retrieval_data")
     def load_sample_retrieval_data(self, sample):
         content_list = self.load_processed_content(sample, disable_load_image=True)
         question:str = sample[self.config.question_key]
         texts = []
         images = []
         if self.config.use_mix:
-            if self.config.r_mix_key in sample:
-                for page in sample[self.config.r_mix_key][:self.config.top_k]:
-                    if page in sample[self.config.r_image_key]:
-                        origin_image_path = ""
-                        origin_image_path = content_list[page].image_path
-                        images.append(origin_image_path)
-                    if page in sample[self.config.r_text_key]:
-                        texts.append(content_list[page].txt.replace("\n", ""))
-        else:
-            if self.config.r_text_key in sample:
-                for page in sample[self.config.r_text_key][:self.config.top_k]:
-                    texts.append(content_list[page].txt.replace("\n", ""))
-            if self.config.r_image_key in sample:
-                for page in sample[self.config.r_image_key][:self.config.top_k]:
+            # A mix page is sent as image and/or text depending on which retriever returned it.
+            r_top_k = self.config.r_top_k
+            image_pages = set(self.retrieved_pages(sample, self.config.r_image_key, self.config.r_image_ranking_key, r_top_k))
+            text_pages = set(self.retrieved_pages(sample, self.config.r_text_key, self.config.r_text_ranking_key, r_top_k))
+            for page in self.retrieved_pages(sample, self.config.r_mix_key, self.config.r_mix_ranking_key):
+                if page in image_pages:
                     origin_image_path = ""
-                    origin_image_path = content_list[page].image_path
+                    origin_image_path = content_list.image_path(page)
                     images.append(origin_image_path)
-                        
+                if page in text_pages:
+                    texts.append(content_list.txt(page).replace("\n", ""))
+        else:
+            for page in self.retrieved_pages(sample, self.config.r_text_key, self.config.r_text_ranking_key):
+                texts.append(content_list.txt(page).replace("\n", ""))
+            for page in self.retrieved_pages(sample, self.config.r_image_key, self.config.r_image_ranking_key):
+                origin_image_path = ""
+                origin_image_path = content_list.image_path(page)
+                images.append(origin_image_path)
+        
+        record(images=len(images))
         return question, texts, images
     
+    def retrieved_pages(self, sample, result_key, ranking_key, top_k=None):
+        """
+        Top top_k (default dataset.top_k) pages of one retriever. They are sliced from the stored full ranking when the
+        sample references one, so they follow top_k and not the top_k used at retrieval time.
+        """
+        if top_k is None:
+            top_k = self.config.top_k
+        if self.rankings is not None and ranking_key in sample:
+            ranking = self.rankings.get(*sample[ranking_key])
+            if ranking is not None:
+                return ranking[0][:top_k]
+        return sample.get(result_key, [])[:top_k]
+    
     def load_full_data(self):
         samples = self.load_data(use_retreival=False)
-        for sample in tqdm(samples):
+        for sample in tqdm(self.iter_by_document(samples), total=len(samples)):
             _, sample["texts"], sample["images"] = self.load_sample_full_data(sample)
         return samples
     
@@ -115,72 +285,234 @@ class BaseDataset():
         else:
             sample_no_list = [i for i in range(0,min(len(content_list),self.config.vlm_max_page))]
         for page in sample_no_list:
-            texts.append(content_list[page].txt.replace("\n", ""))
+            texts.append(content_list.txt(page).replace("\n", ""))
             origin_image_path = ""
-            origin_image_path = content_list[page].image_path
+            origin_image_path = content_list.image_path(page)
             images.append(origin_image_path)
                         
         return question, texts, images
       
-    def load_processed_content(self, sample: dict, disable_load_image=True)->list[Content]:
+    def document_order(self, samples):
+        """Sample indices grouped by document so consecutive samples hit the content cache. The list itself keeps its order."""
+        if not self.config.sort_by_document:
+            return list(range(len(samples)))
+        return sorted(range(len(samples)), key=lambda i: samples[i]["doc_id"])
+    
+    def iter_by_document(self, samples):
+        return (samples[i] for i in self.document_order(samples))
+    
+    def load_processed_content(self, sample: dict, disable_load_image=True)->DocumentContent:
         doc_name = self.EXTRACT_DOCUMENT_ID(sample)
-        content_list = []
-        for page_idx in range(self.config.max_page):
-            im_file = self.IM_FILE(doc_name, page_idx)
-            text_file = self.TEXT_FILE(doc_name, page_idx)
-            if not os.path.exists(im_file):
-                break
-            img = None
-            if not disable_load_image:
-                img = self.load_image(im_file)
-            txt = self.load_txt(text_file)
-            content_list.append(Content(image=img, image_path=im_file, txt=txt)) 
-        return content_list
+        if self.config.content_cache_mb > 0:
+            content = self.content_cache.get_or_load(doc_name, lambda: self._load_cached_content(doc_name))
+        else:
+            content = self._load_processed_content(doc_name)
+        return content.view(with_image=not disable_load_image)
+    
+    def _load_cached_content(self, doc_name):
+        content = self._load_processed_content(doc_name)
+        content.on_load = lambda: self.content_cache.resize(doc_name)
+        return content
+    
+    def _load_processed_content(self, doc_name)->DocumentContent:
+        manifest = self.load_manifest(doc_name)
+        packed_path = page_store.packed_file(self.config.extract_path, doc_name)
+        if manifest is not None and manifest["format"] == "files":
+            packed_path = None
+            num_pages = manifest["num_pages"]
+        elif os.path.exists(packed_path):
+            num_pages = len(page_store.open_packed(packed_path))
+        else:
+            # Extracted before manifests existed: probe page images until one is missing.
+            packed_path = None
+            num_pages = 0
+            while num_pages < self.config.max_page and os.path.exists(self.IM_FILE(doc_name, num_pages)):
+                num_pages += 1
+        num_pages = min(num_pages, self.config.max_page)
+        return DocumentContent(self, doc_name, num_pages, packed_path=packed_path, manifest=manifest)
+    
+    def load_manifest(self, doc_name):
+        path = self.MANIFEST_FILE(doc_name)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
     
     def load_image(self, file):
-        pil_im = Image.open(file)
+        pil_im = page_store.load_image(file)
         return pil_im
 
     def load_txt(self, file):
+        with open(file, 'rb') as f:
+            return self.decode_txt(f.read())
+    
+    def decode_txt(self, data: bytes):
         max_length = self.config.max_character_per_page
         try:
-            with open(file, 'r', encoding='utf-8') as file:
-                content = file.read()
+            content = data.decode('utf-8')
         except UnicodeDecodeError:
             # 如果UTF-8失败，尝试其他编码
-            with open(file, 'r', encoding='gbk') as file:
-                content = file.read()
+            content = data.decode('gbk')
         content = content.replace('\r\n', ' ').replace('\r', ' ').replace('\n', ' ')
         return content[:max_length]
     
-    def extract_content(self, resolution=144):
-        samples = self.load_data()
-        for sample in tqdm(samples):
-            self._extract_content(sample, resolution=resolution)
+    def extract_content(self, resolution=144, num_workers=None):
+        if num_workers is None:
+            num_workers = self.config.extract_workers
+        packed = self.config.extract_format == "packed"
+        os.makedirs(self.config.extract_path, exist_ok=True)
+        
+        # Each document is rendered once, no matter how many samples refer to it.
+        documents = {}
+        for sample in self.iter_samples(use_retreival=False):
+            if sample["doc_id"] not in documents:
+                documents[sample["doc_id"]] = self.EXTRACT_DOCUMENT_ID(sample)
+        
+        tasks = []
+        failed = set()
+        for doc_id, doc_name in documents.items():
+            pdf_path = os.path.join(self.config.document_path, doc_id)
+            try:
+                with pymupdf.open(pdf_path) as pdf:
+                    num_pages = min(pdf.page_count, self.config.max_page)
+            except Exception as e:
+                failed.add(doc_id)
+                print(f"Error extracting {doc_id}: {e}")
+                continue
+            if packed:
+                # A packed file is written by a single task per document.
+                tasks.append((doc_id, (pdf_path, doc_name, self.config.extract_path, num_pages, resolution)))
+                continue
+            chunk = self.config.extract_chunk_pages if num_workers > 1 else num_pages
+            for start in range(0, num_pages, max(chunk, 1)):
+                tasks.append((doc_id, (pdf_path, doc_name, self.config.extract_path, start, min(start + chunk, num_pages), resolution)))
+        
+        extract_fn = extract_packed_document if packed else extract_pages
+        doc_pages = {doc_id: [] for doc_id in documents}
+        if num_workers > 1:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                futures = {executor.submit(extract_fn, *args): doc_id for doc_id, args in tasks}
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    doc_id = futures[future]
+                    try:
+                        doc_pages[doc_id].extend(future.result())
+                    except Exception as e:
+                        failed.add(doc_id)
+                        print(f"Error extracting {doc_id}: {e}")
+        else:
+            for doc_id, args in tqdm(tasks):
+                if doc_id in failed:
+                    continue
+                try:
+                    doc_pages[doc_id].extend(extract_fn(*args))
+                except Exception as e:
+                    failed.add(doc_id)
+                    print(f"Error extracting {doc_id}: {e}")
+        
+        for doc_id, pages in doc_pages.items():
+            if doc_id not in failed:
+                self.dump_manifest(documents[doc_id], doc_id, pages, extract_format=self.config.extract_format)
+        
+        page_counts = {doc_id: len(pages) for doc_id, pages in doc_pages.items() if doc_id not in failed}
+        print(f"Extracted {sum(page_counts.values())} pages from {len(page_counts)} documents, {len(failed)} failed.")
+        return page_counts
+    
+    def dump_manifest(self, doc_name, doc_id, pages, extract_format="files"):
+        pages = sorted(pages, key=lambda page: page["index"])
+        manifest = {
+            "doc_id": doc_id,
+            "format": extract_format,
+            "num_pages": len(pages),
+            "pages": [{k: v for k, v in page.items() if k != "index"} for page in pages],
+        }
+        path = self.MANIFEST_FILE(doc_name)
+        with open(path + ".tmp", 'w') as f:
+            json.dump(manifest, f)
+        os.replace(path + ".tmp", path)
+        return path
             
     def _extract_content(self, sample, resolution=144):
         max_pages=self.config.max_page
         os.makedirs(self.config.extract_path, exist_ok=True)
-        image_list = list()
-        text_list = list()
         doc_name = self.EXTRACT_DOCUMENT_ID(sample)
-        with pymupdf.open(os.path.join(self.config.document_path, sample["doc_id"])) as pdf:
-            for index, page in enumerate(pdf[:max_pages]):
-                # save page as an image
-                im_file = self.IM_FILE(doc_name,index)
-                if not os.path.exists(im_file):
-                    im = page.get_pixmap(dpi=resolution)
-                    im.save(im_file)
-                image_list.append(im_file)
-                # save page text
-                txt_file = self.TEXT_FILE(doc_name,index)
-                if not os.path.exists(txt_file):
-                    text = page.get_text("text")
-                    with open(txt_file, 'w') as f:
-                        f.write(text)
-                text_list.append(txt_file)
-                
+        pdf_path = os.path.join(self.config.document_path, sample["doc_id"])
+        if self.config.extract_format == "packed":
+            pages = extract_packed_document(pdf_path, doc_name, self.config.extract_path, max_pages, resolution)
+            self.dump_manifest(doc_name, sample["doc_id"], pages, extract_format="packed")
+            packed_path = page_store.packed_file(self.config.extract_path, doc_name)
+            refs = [page_store.packed_ref(packed_path, index) for index in range(len(pages))]
+            return refs, refs
+        pages = extract_pages(pdf_path, doc_name, self.config.extract_path, 0, max_pages, resolution)
+        self.dump_manifest(doc_name, sample["doc_id"], pages)
+        image_list = [self.IM_FILE(doc_name, index) for index in range(len(pages))]
+        text_list = [self.TEXT_FILE(doc_name, index) for index in range(len(pages))]
         return image_list, text_list
+
+def im_file(extract_path, doc_name, index):
+    return f"{extract_path}/{doc_name}_{index}.png"
+
+def text_file(extract_path, doc_name, index):
+    return f"{extract_path}/{doc_name}_{index}.txt"
+
+def manifest_file(extract_path, doc_name):
+    return f"{extract_path}/{doc_name}.manifest.json"
+
+def page_meta(index, text, image_size, image_bytes):
+    return {"index": index, "text_length": len(text), "image_size": list(image_size), "image_bytes": image_bytes}
+
+def extract_pages(pdf_path, doc_name, extract_path, start, stop, resolution=144):
+    """
+    Render pages [start, stop) of a PDF into page images and texts. Runs in worker processes.
+    :return: The manifest entries of the pages handled.
+    """
+    pages = []
+    with pymupdf.open(pdf_path) as pdf:
+        for index in range(start, min(stop, pdf.page_count)):
+            page = pdf[index]
+            # save page as an image
+            page_im_file = im_file(extract_path, doc_name, index)
+            if not os.path.exists(page_im_file):
+                im = page.get_pixmap(dpi=resolution)
+                im.save(page_im_file)
+                image_size = (im.width, im.height)
+            else:
+                with Image.open(page_im_file) as im:
+                    image_size = im.size
+            # save page text
+            page_text_file = text_file(extract_path, doc_name, index)
+            if not os.path.exists(page_text_file):
+                text = page.get_text("text")
+                with open(page_text_file, 'w') as f:
+                    f.write(text)
+            else:
+                with open(page_text_file, 'rb') as f:
+                    text = f.read().decode('utf-8', errors='replace')
+            pages.append(page_meta(index, text, image_size, os.path.getsize(page_im_file)))
+    return pages
+
+def extract_packed_document(pdf_path, doc_name, extract_path, max_pages, resolution=144):
+    """
+    Render a PDF into a single packed page file (see mydatasets/page_store.py).
+    :return: The manifest entries of the packed pages.
+    """
+    path = page_store.packed_file(extract_path, doc_name)
+    if os.path.exists(path):
+        reader = page_store.PackedPageReader(path)
+        pages = []
+        for index, page in enumerate(reader.pages):
+            image_size = page.get("image_size") or reader.open_image(index).size
+            pages.append(page_meta(index, reader.read_text_bytes(index).decode("utf-8", errors="replace"), image_size, page["image"][1]))
+        return pages
+    pages = []
+    with pymupdf.open(pdf_path) as pdf, page_store.PackedPageWriter(path) as writer:
+        for index in range(min(max_pages, pdf.page_count)):
+            page = pdf[index]
+            im = page.get_pixmap(dpi=resolution)
+            text = page.get_text("text")
+            image = im.tobytes("png")
+            writer.add_page(text.encode("utf-8"), image, image_size=[im.width, im.height])
+            pages.append(page_meta(index, text, (im.width, im.height), len(image)))
+    return pages
     
 def extract_time(file_path):
     file_name = os.path.basename(file_path)
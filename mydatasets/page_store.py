@@ -0,0 +1,128 @@
+import io
+import json
+import mmap
+import os
+import struct
+from functools import lru_cache
+from PIL import Image
+
+# Packed page file layout:
+#   MAGIC | page blobs (text, image, text, image, ...) | json index | footer
+# The footer stores the offset and length of the json index, so a reader only needs
+# one open() and one mmap() per document instead of two files per page.
+MAGIC = b"MDPAGES1"
+FOOTER = struct.Struct("<QQ8s")
+PACKED_SUFFIX = ".pages"
+REF_SEPARATOR = "#page="
+
+def packed_file(extract_path, doc_name):
+    return f"{extract_path}/{doc_name}{PACKED_SUFFIX}"
+
+def packed_ref(path, index):
+    """Reference to one page image inside a packed file, usable wherever an image path is expected."""
+    return f"{path}{REF_SEPARATOR}{index}"
+
+def is_packed_ref(image_path):
+    return isinstance(image_path, str) and REF_SEPARATOR in image_path
+
+def parse_packed_ref(image_path):
+    path, index = image_path.rsplit(REF_SEPARATOR, 1)
+    return path, int(index)
+
+class PackedPageWriter():
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.file = open(self.tmp_path, "wb")
+        self.file.write(MAGIC)
+        self.pages = []
+
+    def _write_blob(self, data):
+        offset = self.file.tell()
+        self.file.write(data)
+        return [offset, len(data)]
+
+    def add_page(self, text: bytes, image: bytes, **meta):
+        page = {"text": self._write_blob(text), "image": self._write_blob(image)}
+        page.update(meta)
+        self.pages.append(page)
+
+    def close(self, **meta):
+        index = dict(meta)
+        index["pages"] = self.pages
+        index_bytes = json.dumps(index).encode("utf-8")
+        offset = self.file.tell()
+        self.file.write(index_bytes)
+        self.file.write(FOOTER.pack(offset, len(index_bytes), MAGIC))
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+class PackedPageReader():
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset, length, magic = FOOTER.unpack(self.mm[-FOOTER.size:])
+        if magic != MAGIC or self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"Not a packed page file: {path}")
+        self.index = json.loads(self.mm[offset:offset + length].decode("utf-8"))
+        self.pages = self.index["pages"]
+
+    def __len__(self):
+        return len(self.pages)
+
+    def _read(self, entry):
+        offset, length = entry
+        return self.mm[offset:offset + length]
+
+    def read_text_bytes(self, index):
+        return self._read(self.pages[index]["text"])
+
+    def read_image_bytes(self, index):
+        return self._read(self.pages[index]["image"])
+
+    def open_image(self, index):
+        return Image.open(io.BytesIO(self.read_image_bytes(index)))
+
+def open_packed(path):
+    # Keyed on the file's mtime and size as well, so a file rewritten by a new extraction is opened again.
+    stat = os.stat(path)
+    return _open_packed(path, stat.st_mtime_ns, stat.st_size)
+
+@lru_cache(maxsize=128)
+def _open_packed(path, mtime_ns, size):
+    return PackedPageReader(path)
+
+def read_image_bytes(image_path):
+    """Read the encoded bytes of a page image given a plain path or a packed page reference."""
+    if is_packed_ref(image_path):
+        path, index = parse_packed_ref(image_path)
+        return open_packed(path).read_image_bytes(index)
+    with open(image_path, "rb") as f:
+        return f.read()
+
+def load_image(image_path):
+    if is_packed_ref(image_path):
+        path, index = parse_packed_ref(image_path)
+        return open_packed(path).open_image(index)
+    return Image.open(image_path)
+
+def resolve_image(image_path):
+    """Plain paths are returned unchanged, packed page references are opened as PIL images."""
+    if is_packed_ref(image_path):
+        return load_image(image_path)
+    return image_path
@@ -0,0 +1,57 @@
+import hashlib
+import json
+import os
+import sqlite3
+import numpy as np
+
+class RankingStore():
+    """
+    Full page rankings of every retriever in one sqlite file, keyed by (retriever, question hash, doc_id).
+    Rankings do not depend on top_k, so any top_k can be sliced out of them without retrieving again.
+    Pages are stored as int32 and scores as float32 blobs. put() only stages rows; flush() commits them.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+
+    def __getstate__(self):
+        # sqlite connections cannot be pickled; worker copies reconnect on first use.
+        state = dict(self.__dict__)
+        state["conn"] = None
+        return state
+
+    def connect(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS rankings (retriever TEXT, question_hash TEXT, doc_id TEXT, pages BLOB, scores BLOB, PRIMARY KEY (retriever, question_hash, doc_id))")
+        return self.conn
+
+    def get(self, retriever, question_hash, doc_id):
+        """:return: (pages, scores) lists, or None when the ranking is not stored."""
+        row = self.connect().execute("SELECT pages, scores FROM rankings WHERE retriever = ? AND question_hash = ? AND doc_id = ?", (retriever, question_hash, doc_id)).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.int32).tolist(), np.frombuffer(row[1], dtype=np.float32).tolist()
+
+    def put(self, retriever, question_hash, doc_id, pages, scores):
+        pages = np.asarray(pages, dtype=np.int32).tobytes()
+        scores = np.asarray(scores, dtype=np.float32).tobytes()
+        self.connect().execute("INSERT OR REPLACE INTO rankings VALUES (?, ?, ?, ?, ?)", (retriever, question_hash, doc_id, pages, scores))
+
+    def flush(self):
+        if self.conn is not None:
+            self.conn.commit()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+
+def question_hash(question, page_ids=None, fingerprint=None):
+    """
+    Hash of a question, its optional page_ids, which restrict the ranking, and the fingerprint of the document's
+    extracted pages, so rankings of a re-extracted document are not reused.
+    """
+    return hashlib.sha1(json.dumps([question, page_ids, fingerprint]).encode("utf-8")).hexdigest()
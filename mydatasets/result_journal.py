@@ -0,0 +1,63 @@
+import json
+import os
+
+JOURNAL_SUFFIX = ".journal.jsonl"
+
+class ResultJournal():
+    """
+    Append-only log of per-sample results. Each line is {"index": <sample position>, "result": {...}},
+    so checkpointing costs one line per sample instead of rewriting the whole result file.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        drop_partial_line(path)
+        self.file = open(path, "a", encoding="utf-8")
+
+    def append(self, index, result):
+        self.file.write(json.dumps({"index": index, "result": result}) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def drop_partial_line(path):
+    # A crash can leave half a record at the end; cut it so the next append starts on a fresh line.
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    with open(path, "rb+") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) == b"\n":
+            return
+        f.seek(0)
+        f.truncate(f.read().rfind(b"\n") + 1)
+
+def read_journal(path):
+    """
+    :return: Dict from sample index to its latest result. A truncated last line (e.g. after a crash) is ignored.
+    """
+    results = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skip broken journal line in {path}.")
+                continue
+            results[record["index"]] = record["result"]
+    return results
+
+def apply_journal(samples, results):
+    for index, result in results.items():
+        if index < len(samples):
+            samples[index].update(result)
+    return samples
@@ -1,4 +1,5 @@
 from mydatasets.base_dataset import BaseDataset
+from mydatasets.ranking_store import question_hash
 
 class BaseRetrieval():
     def __init__(self, config):
@@ -8,4 +9,63 @@ class BaseRetrieval():
         pass
     
     def find_top_k(self, dataset: BaseDataset):
-        pass
\ No newline at end of file
+        pass
+    
+    def find_samples_top_k(self, dataset: BaseDataset, samples):
+        """Retrieve for the given samples only, writing their result keys like find_top_k; used by the retrieval server."""
+        raise NotImplementedError(f"{type(self).__name__} does not retrieve for single samples")
+    
+    def result_keys(self):
+        """Sample keys this retriever writes its results to; the retrieval server reports them to clients."""
+        return []
+    
+    def ranking_keys(self, dataset: BaseDataset, kind):
+        """
+        Resolved sample keys of the text or image rankings. Config interpolations are resolved on every access,
+        which is too slow to repeat for every sample.
+        """
+        return {
+            "result": self.config["r_" + kind + "_key"],
+            "ranking": self.config["r_" + kind + "_ranking_key"],
+            "question": self.config[kind + "_question_key"],
+            "page_id": dataset.config.page_id_key,
+            "doc": self.config.doc_key,
+            "name": self.config.ranking_name,
+            "top_k": self.config.top_k,
+        }
+    
+    def ranking_ref(self, dataset: BaseDataset, sample, keys):
+        """
+        Key of the sample's ranking in dataset.rankings: [retriever, question hash, doc_id]. The hash covers the
+        fingerprint of the document's pages, so a document extracted (and embedded) again gets new rankings.
+        """
+        fingerprint = dataset.load_processed_content(sample).fingerprint
+        return [keys["name"], question_hash(sample[keys["question"]], sample.get(keys["page_id"]), fingerprint), sample[keys["doc"]]]
+    
+    def load_ranking(self, dataset: BaseDataset, sample, keys):
+        """
+        Fill the result key from the stored ranking of this retriever for the sample, without retrieving again.
+        :return: Whether a ranking was stored.
+        """
+        if dataset.rankings is None:
+            return False
+        ref = self.ranking_ref(dataset, sample, keys)
+        ranking = dataset.rankings.get(*ref)
+        if ranking is None:
+            return False
+        sample[keys["result"]] = ranking[0][:keys["top_k"]]
+        sample[keys["result"]+"_score"] = ranking[1][:keys["top_k"]]
+        sample[keys["ranking"]] = ref
+        return True
+    
+    def save_ranking(self, dataset: BaseDataset, sample, keys, pages, scores):
+        """Store the full ranking of a sample and write its top_k pages to the result key and its _score key."""
+        sample[keys["result"]] = pages[:keys["top_k"]]
+        sample[keys["result"]+"_score"] = scores[:keys["top_k"]]
+        if dataset.rankings is None:
+            # A reference left by an earlier run would point to a ranking these results replace.
+            sample.pop(keys["ranking"], None)
+            return
+        ref = self.ranking_ref(dataset, sample, keys)
+        dataset.rankings.put(*ref, pages, scores)
+        sample[keys["ranking"]] = ref
@@ -0,0 +1,127 @@
+import re
+import numpy as np
+from tqdm import tqdm
+
+from retrieval.base_retrieval import BaseRetrieval
+from mydatasets.base_dataset import BaseDataset
+from utils.lru_cache import LRUCache
+from utils.profiler import profile_stage, profiler
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+class BM25Retrieval(BaseRetrieval):
+    """
+    Lexical page retrieval with BM25 over the extracted page texts. Every document gets a small in-memory
+    inverted index, built in milliseconds from its texts and kept in an LRU cache, so there is no model to load
+    and nothing to store on disk. Results go to r_text_key like ColbertRetrieval, so the rest of the pipeline
+    does not change.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.indexes = LRUCache(max_items=config.index_cache_size)
+
+    def load_index(self, dataset: BaseDataset, sample):
+        def build():
+            content_list = dataset.load_processed_content(sample)
+            # Lines are joined with a space so words at line ends are not glued together.
+            texts = [content_list.txt(page).replace("\n", " ") for page in range(len(content_list))]
+            return LexicalIndex(texts, k1=self.config.k1, b=self.config.b)
+        return self.indexes.get_or_load(sample[self.config.doc_key], build)
+
+    def prepare(self, dataset: BaseDataset):
+        samples = dataset.load_data(use_retreival=True)
+        for sample in tqdm(samples):
+            self.load_index(dataset, sample)
+        return samples
+
+    @profile_stage("retrieval")
+    def find_sample_top_k(self, dataset: BaseDataset, sample, top_k: int, page_id_key: str):
+        index = self.load_index(dataset, sample)
+        page_id_list = sample.get(page_id_key)
+        if page_id_list is not None:
+            assert isinstance(page_id_list, list)
+        return index.search(sample[self.config.text_question_key], top_k, page_id_list)
+
+    def find_samples_top_k(self, dataset: BaseDataset, samples, indices=None):
+        """Search the given samples and write their result keys like find_top_k. indices are the sample numbers used in the profile."""
+        if indices is None:
+            indices = list(range(len(samples)))
+        keys = self.ranking_keys(dataset, "text")
+        top_k = self.config.top_k if dataset.rankings is None else None
+        # Samples of the same document are searched one after another, so each index is built once.
+        doc_samples = {}
+        for index, sample in zip(indices, samples):
+            doc_samples.setdefault(sample[self.config.doc_key], []).append((index, sample))
+        with tqdm(total=len(samples)) as pbar:
+            for doc_sample_list in doc_samples.values():
+                for index, sample in doc_sample_list:
+                    with profiler.sample(index):
+                        top_page_indices, top_page_scores = self.find_sample_top_k(dataset, sample, top_k=top_k, page_id_key=keys["page_id"])
+                    self.save_ranking(dataset, sample, keys, top_page_indices, top_page_scores)
+                    pbar.update(1)
+
+    def result_keys(self):
+        return [self.config.r_text_key]
+
+    def find_top_k(self, dataset: BaseDataset, force_prepare=False):
+        samples = dataset.load_data(use_retreival=True)
+        keys = self.ranking_keys(dataset, "text")
+        indices = [index for index, sample in enumerate(samples) if not self.load_ranking(dataset, sample, keys)]
+        self.find_samples_top_k(dataset, [samples[index] for index in indices], indices)
+        print(f"Index cache: {self.indexes.stats()}")
+        path = dataset.dump_data(samples, use_retreival=True)
+        print(f"Save retrieval results at {path}.")
+
+class LexicalIndex():
+    """
+    Inverted index over the pages of one document. Postings are stored term by term in flat arrays (CSR layout),
+    each with its precomputed BM25 weight, so a query is one gather and one bincount over the postings of its terms.
+    """
+    def __init__(self, texts, k1=1.2, b=0.75):
+        self.num_pages = len(texts)
+        self.vocab = {}
+        term_ids, page_ids = [], []
+        for page, text in enumerate(texts):
+            tokens = tokenize(text)
+            term_ids.extend(self.vocab.setdefault(token, len(self.vocab)) for token in tokens)
+            page_ids.extend([page] * len(tokens))
+        term_ids = np.array(term_ids, dtype=np.int64)
+        page_ids = np.array(page_ids, dtype=np.int64)
+        page_lengths = np.bincount(page_ids, minlength=self.num_pages).astype(np.float32)
+
+        # One posting per (term, page) pair with its term frequency, sorted by term.
+        pairs, tf = np.unique(term_ids * self.num_pages + page_ids, return_counts=True)
+        terms = pairs // max(self.num_pages, 1)
+        self.postings = (pairs % max(self.num_pages, 1)).astype(np.int32)
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(terms, minlength=len(self.vocab)))])
+
+        df = np.diff(self.offsets).astype(np.float32)
+        idf = np.log1p((self.num_pages - df + 0.5) / (df + 0.5))
+        avg_length = page_lengths.mean() if self.num_pages and page_lengths.sum() > 0 else 1.0
+        norm = k1 * (1 - b + b * page_lengths / avg_length)
+        self.weights = (idf[terms] * tf * (k1 + 1) / (tf + norm[self.postings])).astype(np.float32)
+
+    def __len__(self):
+        return self.num_pages
+
+    def scores(self, query):
+        """BM25 score of every page; a term repeated in the query counts once per occurrence."""
+        term_ids = [self.vocab[token] for token in tokenize(query) if token in self.vocab]
+        if not term_ids:
+            return np.zeros(self.num_pages, dtype=np.float32)
+        postings = np.concatenate([np.arange(self.offsets[t], self.offsets[t + 1]) for t in term_ids])
+        return np.bincount(self.postings[postings], weights=self.weights[postings], minlength=self.num_pages).astype(np.float32)
+
+    def search(self, query, top_k=None, page_id_list=None):
+        """
+        Top pages by score, restricted to page_id_list when it is given. Every candidate page is ranked,
+        pages without a matching term last in page order, so top_k pages are returned like with ColBERT.
+        :return: (top_page_indices, top_page_scores), every candidate page when top_k is None.
+        """
+        scores = self.scores(query)
+        pages = np.arange(self.num_pages) if page_id_list is None else np.array([page for page in dict.fromkeys(page_id_list) if 0 <= page < self.num_pages], dtype=np.int64)
+        order = np.argsort(-scores[pages], kind="stable")[:top_k]
+        return pages[order].tolist(), scores[pages[order]].tolist()
@@ -0,0 +1,48 @@
+import json
+import urllib.error
+import urllib.request
+
+class RetrievalClient():
+    """
+    Thin client of the retrieval server started by scripts/serve_retrieval.py. It only uses the standard library,
+    so callers do not import any retrieval model.
+    """
+    def __init__(self, url, timeout=600, batch_size=64):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.batch_size = batch_size
+
+    def request(self, path, payload=None):
+        data = None if payload is None else json.dumps(payload).encode("utf-8")
+        request = urllib.request.Request(self.url + path, data=data, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read().decode("utf-8"))
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f"Retrieval server error on {path}: {e.read().decode('utf-8', 'replace')}") from e
+
+    def health(self):
+        return self.request("/health")
+
+    def result_keys(self):
+        """Sample keys the server's retrievers write results to."""
+        return [key for keys in self.health()["keys"].values() for key in keys]
+
+    def find_top_k(self, samples, retrievals=None):
+        """
+        :param retrievals: Names of the server's retrievers to run, None for all of them.
+        :return: Per sample, the keys the retrievers added or changed (results, scores and ranking references).
+        """
+        return self.request("/find_top_k", {"samples": samples, "retrievals": retrievals})["updates"]
+
+    def retrieve(self, samples, retrievals=None):
+        """Retrieve for samples in batches of batch_size and update them in place."""
+        for start in range(0, len(samples), self.batch_size):
+            batch = samples[start:start + self.batch_size]
+            for sample, update in zip(batch, self.find_top_k(batch, retrievals)):
+                sample.update(update)
+        return samples
+
+    def run(self, retrieval):
+        """Run find_top_k of one retriever over the server's whole dataset. :return: Path of the saved samples."""
+        return self.request("/run", {"retrieval": retrieval})["path"]
@@ -0,0 +1,88 @@
+import math
+import numpy as np
+import torch
+from scipy.cluster.hierarchy import fcluster, linkage
+
+COMPRESSIONS = ("none", "int8", "binary")
+SCORE_CHUNK_PAGES = 32 # Compressed pages dequantized at a time while scoring
+
+def compression_tag(compression, pool_factor):
+    """Name of a compressed variant, e.g. "int8-pool2"; None when nothing is compressed."""
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression {compression}, expected one of {COMPRESSIONS}")
+    parts = []
+    if compression != "none":
+        parts.append(compression)
+    if pool_factor > 1:
+        parts.append(f"pool{pool_factor}")
+    return "-".join(parts) or None
+
+def pool_tokens(page_embeds, pool_factor):
+    """
+    Hierarchical token pooling: the vectors of each page are clustered (Ward linkage) into
+    ceil(tokens / pool_factor) groups, and every group is replaced by its renormalized mean.
+    Every page is padded to ceil(tokens / pool_factor) vectors with copies of its first vector, which leaves MaxSim
+    unchanged, so any slice of pages pools to the same shape.
+    """
+    pages = []
+    for page in page_embeds.float():
+        page = page[page.norm(dim=-1) > 0]
+        num_clusters = max(1, math.ceil(len(page) / pool_factor))
+        if len(page) > num_clusters:
+            labels = torch.from_numpy(fcluster(linkage(page.numpy(), method="ward"), t=num_clusters, criterion="maxclust"))
+            page = torch.stack([page[labels == label].mean(dim=0) for label in labels.unique()])
+            page = torch.nn.functional.normalize(page, dim=-1)
+        pages.append(page)
+    num_tokens = math.ceil(page_embeds.shape[1] / pool_factor)
+    pages = [torch.cat([page, page[:1].expand(num_tokens - len(page), -1)]) for page in pages]
+    return torch.stack(pages)
+
+def quantize(embeds, compression):
+    """ColPali vectors are unit length, so int8 uses the fixed scale 127 and binary keeps the sign bits."""
+    embeds = embeds.float()
+    if compression == "int8":
+        return (embeds * 127).round().clamp(-127, 127).to(torch.int8)
+    if compression == "binary":
+        return torch.from_numpy(np.packbits(embeds.numpy() > 0, axis=-1))
+    return embeds
+
+def dequantize(codes, compression, dim):
+    """Float vectors for MaxSim; binary codes become +-1/sqrt(dim) so every vector keeps unit length."""
+    if compression == "int8":
+        return codes.float() / 127
+    if compression == "binary":
+        bits = np.unpackbits(codes.numpy(), axis=-1, count=dim)
+        return (torch.from_numpy(bits).float() * 2 - 1) / math.sqrt(dim)
+    return codes.float()
+
+class CompressedPages():
+    """
+    The compressed pages of one document, kept as their int8 or binary codes. chunks() dequantizes a few pages at
+    a time, so scoring never holds the whole document in float32.
+    """
+    def __init__(self, codes, compression, dim):
+        self.codes = codes
+        self.compression = compression
+        self.dim = dim
+
+    def __len__(self):
+        return len(self.codes)
+
+    def index_select(self, dim, index):
+        assert dim == 0
+        return CompressedPages(self.codes.index_select(0, index), self.compression, self.dim)
+
+    def chunks(self, chunk_pages=SCORE_CHUNK_PAGES):
+        for start in range(0, len(self.codes), chunk_pages):
+            yield dequantize(self.codes[start:start + chunk_pages], self.compression, self.dim)
+
+def page_vectors(embeds):
+    """One renormalized mean vector per page, for coarse candidate generation."""
+    return torch.nn.functional.normalize(embeds.float().mean(dim=1), dim=-1).to(embeds.dtype)
+
+def compress(embeds, compression, pool_factor):
+    if pool_factor > 1:
+        embeds = pool_tokens(embeds, pool_factor).to(embeds.dtype)
+    if compression == "none":
+        return embeds
+    return quantize(embeds, compression)
@@ -0,0 +1,228 @@
+import hashlib
+import json
+import os
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from mydatasets.base_dataset import BaseDataset
+from retrieval.embedding_store import EmbeddingStore, write_atomic
+from retrieval.image_retrieval import ColpaliRetrieval, colbert_scores
+from utils.profiler import profile_stage
+
+class CorpusRetrieval(ColpaliRetrieval):
+    """
+    Open-domain page retrieval over every document of the dataset, without using the sample's doc_id.
+    Page vectors are assigned to k-means centroids once per document. A question probes the nprobe nearest
+    centroids of each of its tokens, ranks the pages listed under them by their centroid scores, and reranks
+    the best candidate_k pages with exact MaxSim. New or changed documents are assigned to the existing
+    centroids, so the corpus grows without retraining or rebuilding the other documents.
+    """
+    def prepare(self, dataset: BaseDataset, samples=None, force=False):
+        document_embeds = super().prepare(dataset, samples, force=force)
+        self.load_index(document_embeds, rebuild=set(document_embeds.keys()) if force else None)
+        return document_embeds
+
+    def load_index(self, document_embeds: EmbeddingStore, rebuild=None):
+        centroids = self.load_centroids(document_embeds)
+        tag = "corpus-" + hashlib.sha1(centroids.numpy().tobytes()).hexdigest()[:8]
+        codes = self.derive_embeds(document_embeds, tag, lambda embeds: assign_centroids(embeds, centroids), rebuild=rebuild)
+        # The inverted lists are stored next to the centroids; only documents that are new or changed are added.
+        path = document_embeds.root + "_" + tag + "_index.npz"
+        index = CorpusIndex.load(path, centroids) if os.path.exists(path) else CorpusIndex(centroids)
+        fingerprints = {doc_id: codes.index[doc_id].get("fingerprint") or "" for doc_id in document_embeds.keys()}
+        if rebuild or any(doc_id not in fingerprints or fingerprints[doc_id] != fingerprint for doc_id, fingerprint in index.fingerprints.items()):
+            print("Documents changed or removed since the corpus index was saved, build it again.")
+            index = CorpusIndex(centroids)
+        new_doc_ids = [doc_id for doc_id in fingerprints if doc_id not in index.fingerprints]
+        for doc_id in new_doc_ids:
+            index.add(doc_id, codes[doc_id], fingerprints[doc_id])
+        if new_doc_ids or not os.path.exists(path):
+            index.save(path)
+        return index
+
+    def load_centroids(self, document_embeds: EmbeddingStore):
+        path = document_embeds.root + "_centroids.npy"
+        if os.path.exists(path):
+            return torch.from_numpy(np.load(path))
+        # Train on a sample of page vectors spread over all documents embedded so far.
+        doc_ids = [doc_id for doc_id in document_embeds.keys() if document_embeds[doc_id] is not None]
+        generator = torch.Generator().manual_seed(0)
+        per_doc = max(1, self.config.kmeans_sample // max(1, len(doc_ids)))
+        vectors = []
+        for doc_id in doc_ids:
+            embeds = document_embeds[doc_id].reshape(-1, document_embeds[doc_id].shape[-1])
+            picked = embeds[torch.randperm(len(embeds), generator=generator)[:per_doc]].float()
+            vectors.append(picked[picked.norm(dim=-1) > 0])
+        vectors = torch.cat(vectors)
+        centroids = kmeans(vectors, min(self.config.num_centroids, len(vectors)), self.config.kmeans_iters, generator)
+        np.save(path + ".tmp.npy", centroids.numpy())
+        os.replace(path + ".tmp.npy", path)
+        print(f"Trained {len(centroids)} centroids on {len(vectors)} vectors.")
+        return centroids
+
+    @profile_stage("retrieval")
+    def search_batch(self, samples, document_embeds: EmbeddingStore, index, top_k: int):
+        """
+        :return: A (top_pages, top_page_scores) pair per sample, where top_pages holds [doc_id, page] pairs.
+        """
+        queries = [sample[self.config.image_question_key] for sample in samples]
+        query_embeds = self.embed_queries(queries).cpu()
+        results = []
+        for query_embed in query_embeds:
+            query_embed = query_embed[query_embed.float().norm(dim=-1) > 0]
+            candidates = index.candidates(query_embed, self.config.nprobe, self.config.candidate_k)
+            # Exact MaxSim on the candidates, reading only their pages from each document.
+            pages, scores = [], []
+            for doc_id, doc_pages in group_pages(candidates):
+                page_embeds = document_embeds[doc_id].index_select(0, torch.tensor(doc_pages, dtype=torch.long))
+                scores.append(colbert_scores(query_embed[None], page_embeds)[0].cpu())
+                pages.extend([doc_id, page] for page in doc_pages)
+            if not pages:
+                results.append(([], []))
+                continue
+            top_page = torch.topk(torch.cat(scores), min(top_k, len(pages)))
+            results.append(([pages[i] for i in top_page.indices.tolist()], top_page.values.tolist()))
+        return results
+
+    def search_samples(self, samples, document_embeds: EmbeddingStore, index):
+        """Search the corpus for samples in batches and write their r_corpus_key and its _score key."""
+        batch_size = self.config.query_batch_size
+        for start in tqdm(range(0, len(samples), batch_size)):
+            batch = samples[start:start + batch_size]
+            for sample, (top_pages, top_page_scores) in zip(batch, self.search_batch(batch, document_embeds, index, self.config.top_k)):
+                sample[self.config.r_corpus_key] = top_pages
+                sample[self.config.r_corpus_key+"_score"] = top_page_scores
+
+    def result_keys(self):
+        return [self.config.r_corpus_key]
+
+    def find_samples_top_k(self, dataset: BaseDataset, samples, indices=None):
+        """
+        Search the whole corpus for the given samples and write r_corpus_key, like find_top_k; the documents of the
+        samples are embedded first when needed. Replaces the per-document search of ColpaliRetrieval.
+        """
+        document_embeds = self.load_document_embeds(dataset, samples=samples)
+        self.search_samples(samples, document_embeds, self.load_index(document_embeds))
+
+    def find_top_k(self, dataset: BaseDataset, force_prepare=False):
+        document_embeds = self.load_document_embeds(dataset, force_prepare=force_prepare)
+        index = self.load_index(document_embeds)
+        print(f"Corpus index: {len(index)} pages from {len(index.doc_ids)} documents.")
+        samples = dataset.load_data(use_retreival=True)
+        self.search_samples([sample for sample in samples if self.config.r_corpus_key not in sample], document_embeds, index)
+        path = dataset.dump_data(samples, use_retreival=True)
+        print(f"Save retrieval results at {path}.")
+
+class CorpusIndex():
+    """
+    Inverted lists from centroid to the pages with at least one vector assigned to it.
+    Documents are appended with add(); the lists are rebuilt lazily on the next search or save.
+    """
+    def __init__(self, centroids):
+        self.centroids = centroids.float()
+        self.doc_ids = []
+        self.fingerprints = {}
+        self.pages = []
+        self.pairs = []
+        self.offsets = None
+
+    def __len__(self):
+        return len(self.pages)
+
+    def add(self, doc_id, codes, fingerprint=None):
+        self.fingerprints[doc_id] = fingerprint or ""
+        if codes is None:
+            return
+        codes = codes.numpy()
+        self.doc_ids.append(doc_id)
+        for page, page_codes in enumerate(codes):
+            # -1 marks zero (padding) vectors, which belong to no centroid.
+            page_codes = np.unique(page_codes[page_codes >= 0])
+            self.pairs.append(np.stack([page_codes, np.full(len(page_codes), len(self.pages))], axis=1))
+            self.pages.append((doc_id, page))
+        self.offsets = None
+
+    def build(self):
+        pairs = np.concatenate(self.pairs) if self.pairs else np.zeros((0, 2), dtype=np.int64)
+        pairs = pairs[np.argsort(pairs[:, 0], kind="stable")]
+        self.pairs = [pairs]
+        self.postings = pairs[:, 1]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(pairs[:, 0], minlength=len(self.centroids)))])
+
+    def save(self, path):
+        """Write the inverted lists (CSR postings and offsets), the page table and the indexed documents to one .npz file."""
+        if self.offsets is None:
+            self.build()
+        doc_numbers = {doc_id: number for number, doc_id in enumerate(self.doc_ids)}
+        page_docs = np.array([doc_numbers[doc_id] for doc_id, _ in self.pages], dtype=np.int32)
+        page_numbers = np.array([page for _, page in self.pages], dtype=np.int32)
+        meta = json.dumps({"doc_ids": self.doc_ids, "fingerprints": self.fingerprints})
+        write_atomic(path, lambda f: np.savez(f, postings=self.postings, offsets=self.offsets, page_docs=page_docs, page_numbers=page_numbers, meta=np.array(meta)), "wb")
+
+    @classmethod
+    def load(cls, path, centroids):
+        index = cls(centroids)
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            index.postings = data["postings"]
+            index.offsets = data["offsets"]
+            page_docs, page_numbers = data["page_docs"], data["page_numbers"]
+        index.doc_ids = meta["doc_ids"]
+        index.fingerprints = meta["fingerprints"]
+        index.pages = [(index.doc_ids[doc], int(page)) for doc, page in zip(page_docs.tolist(), page_numbers.tolist())]
+        # The (centroid, page) pairs, so documents added later are merged with the stored lists.
+        index.pairs = [np.stack([np.repeat(np.arange(len(index.offsets) - 1), np.diff(index.offsets)), index.postings], axis=1)]
+        return index
+
+    def candidates(self, query_embed, nprobe, candidate_k):
+        """
+        Pages listed under the nprobe nearest centroids of any query token, ranked by the sum over query tokens of
+        their best probed centroid score on that page.
+        :return: Up to candidate_k (doc_id, page) pairs.
+        """
+        if self.offsets is None:
+            self.build()
+        similarity = query_embed.float() @ self.centroids.T
+        probe = torch.topk(similarity, min(nprobe, len(self.centroids)), dim=-1)
+        probe_ids, probe_scores = probe.indices.numpy(), probe.values.numpy()
+        lists = {c: self.postings[self.offsets[c]:self.offsets[c + 1]] for c in np.unique(probe_ids)}
+        if not lists:
+            return []
+        pages = np.unique(np.concatenate(list(lists.values())))
+        approx = np.zeros((len(query_embed), len(pages)), dtype=np.float32)
+        for token, (token_ids, token_scores) in enumerate(zip(probe_ids, probe_scores)):
+            for c, score in zip(token_ids, token_scores):
+                columns = np.searchsorted(pages, lists[c])
+                approx[token, columns] = np.maximum(approx[token, columns], score)
+        approx = approx.sum(axis=0)
+        best = np.argsort(-approx, kind="stable")[:candidate_k]
+        return [self.pages[i] for i in pages[best]]
+
+def group_pages(pages):
+    groups = {}
+    for doc_id, page in pages:
+        groups.setdefault(doc_id, []).append(page)
+    return groups.items()
+
+def assign_centroids(embeds, centroids, chunk_size=64):
+    """Nearest centroid of every vector of every page, as a (pages, tokens) int32 tensor; zero (padding) vectors get -1."""
+    codes = []
+    for start in range(0, len(embeds), chunk_size):
+        chunk = embeds[start:start + chunk_size].float()
+        chunk_codes = (chunk @ centroids.T).argmax(dim=-1).int()
+        chunk_codes[chunk.norm(dim=-1) == 0] = -1
+        codes.append(chunk_codes)
+    return torch.cat(codes)
+
+def kmeans(vectors, num_centroids, num_iters, generator):
+    """Spherical k-means: vectors go to the centroid with the largest dot product, centroids are renormalized means."""
+    centroids = vectors[torch.randperm(len(vectors), generator=generator)[:num_centroids]].clone()
+    for _ in range(num_iters):
+        assignment = (vectors @ centroids.T).argmax(dim=-1)
+        sums = torch.zeros_like(centroids).index_add_(0, assignment, vectors)
+        counts = torch.bincount(assignment, minlength=num_centroids)
+        # Empty clusters keep their previous centroid.
+        filled = counts > 0
+        centroids[filled] = torch.nn.functional.normalize(sums[filled], dim=-1)
+    return centroids
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import re
+import socket
+import numpy as np
+import torch
+
+INDEX_FILE = "index.json"
+HOST = re.sub(r"[^\w-]", "_", socket.gethostname())
+
+class EmbeddingStore():
+    """
+    Per-document embedding store: <root>/<doc file>.npy holds the (pages, tokens, dim) tensor of one document and
+    <root>/index.json maps doc ids to their files. Documents are memory-mapped on access, so a lookup only
+    touches the pages of that document and costs no copy until the tensor is moved to another device.
+    """
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        remove_stale_tmp(root)
+        self.index = {}
+        index_path = os.path.join(root, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                self.index = json.load(f)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, doc_id):
+        entry = self.index[doc_id]
+        if entry["file"] is None:
+            return None
+        # mmap_mode="c" maps the file copy-on-write, so torch gets a writable view without reading it into RAM.
+        array = np.load(os.path.join(self.root, entry["file"]), mmap_mode="c")
+        return torch.from_numpy(array)
+
+    def get(self, doc_id, default=None):
+        if doc_id not in self.index:
+            return default
+        return self[doc_id]
+
+    def keys(self):
+        return self.index.keys()
+
+    def is_current(self, doc_id, fingerprint):
+        """Whether doc_id is stored and was embedded from the same page set. Entries without a fingerprint are trusted."""
+        entry = self.index.get(doc_id)
+        if entry is None:
+            return False
+        return entry.get("fingerprint") in (None, fingerprint)
+
+    def file_name(self, doc_id):
+        stem = re.sub(r"[^\w.-]", "_", os.path.basename(doc_id))[:80]
+        digest = hashlib.sha1(doc_id.encode("utf-8")).hexdigest()[:12]
+        return f"{stem}-{digest}.npy"
+
+    def put(self, doc_id, embeds, **meta):
+        """Write one document. Pass embeds=None for documents without pages. Call flush() to persist the index."""
+        entry = dict(meta)
+        if embeds is None:
+            entry.update({"file": None, "shape": None, "dtype": None})
+        else:
+            array = to_numpy(embeds)
+            file_name = self.file_name(doc_id)
+            path = os.path.join(self.root, file_name)
+            write_atomic(path, lambda f: np.save(f, array), "wb")
+            entry.update({"file": file_name, "shape": list(array.shape), "dtype": str(array.dtype)})
+        self.index[doc_id] = entry
+
+    def remove(self, doc_id):
+        """Drop one document. Call flush() to persist the index."""
+        entry = self.index.pop(doc_id)
+        if entry["file"] is not None and os.path.exists(os.path.join(self.root, entry["file"])):
+            os.remove(os.path.join(self.root, entry["file"]))
+
+    def writer(self, doc_id, num_pages, **meta):
+        """Write one document in pieces as its pages are embedded; see DocumentWriter."""
+        return DocumentWriter(self, doc_id, num_pages, meta)
+
+    def flush(self):
+        write_atomic(os.path.join(self.root, INDEX_FILE), lambda f: json.dump(self.index, f), "w")
+
+    def nbytes(self):
+        return sum(os.path.getsize(os.path.join(self.root, entry["file"])) for entry in self.index.values() if entry["file"] is not None)
+
+class DocumentWriter():
+    """
+    Writes the pages of one document straight into a memory-mapped .npy file, so only the pages being written
+    are held in memory. close() moves the file into place and adds the document to the store index.
+    """
+    def __init__(self, store, doc_id, num_pages, meta):
+        self.store = store
+        self.doc_id = doc_id
+        self.num_pages = num_pages
+        self.meta = meta
+        self.file_name = store.file_name(doc_id)
+        self.path = os.path.join(store.root, self.file_name)
+        self.tmp_path = tmp_path(self.path)
+        self.array = None
+        self.num_written = 0
+
+    @property
+    def done(self):
+        return self.num_written == self.num_pages
+
+    def write(self, start, embeds):
+        """Write embeds (pages, ...) as pages start, start + 1, ..."""
+        array = to_numpy(embeds)
+        if self.array is None:
+            self.array = np.lib.format.open_memmap(self.tmp_path, mode="w+", dtype=array.dtype, shape=(self.num_pages,) + array.shape[1:])
+        self.array[start:start + len(array)] = array
+        self.num_written += len(array)
+
+    def close(self):
+        if self.array is None:
+            self.store.put(self.doc_id, None, **self.meta)
+            return
+        shape, dtype = list(self.array.shape), str(self.array.dtype)
+        self.array.flush()
+        self.array = None
+        os.replace(self.tmp_path, self.path)
+        self.store.index[self.doc_id] = dict(self.meta, file=self.file_name, shape=shape, dtype=dtype)
+
+    def abort(self):
+        """Drop the pages written so far; the document stays out of the index."""
+        self.array = None
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+def tmp_path(path):
+    # One temporary file per process, so writers sharing a store (e.g. the retrieval server and retrieve.py) never touch each other's files.
+    return f"{path}.{HOST}.{os.getpid()}.tmp"
+
+def pid_alive(pid):
+    if os.name == "nt":
+        # os.kill would terminate the process on Windows, so files there are never treated as stale.
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def remove_stale_tmp(root):
+    """Remove temporary files left by killed writers on this host. Files of live processes and other hosts are kept."""
+    for name in os.listdir(root):
+        parts = name.rsplit(".", 3)
+        if len(parts) != 4 or parts[3] != "tmp" or parts[1] != HOST or not parts[2].isdigit():
+            continue
+        if not pid_alive(int(parts[2])):
+            try:
+                os.remove(os.path.join(root, name))
+            except FileNotFoundError:
+                pass
+
+def write_atomic(path, write_fn, mode):
+    """Write through a temporary file and move it into place; the temporary file is removed if writing fails."""
+    path_tmp = tmp_path(path)
+    try:
+        with open(path_tmp, mode) as f:
+            write_fn(f)
+        os.replace(path_tmp, path)
+    except BaseException:
+        if os.path.exists(path_tmp):
+            os.remove(path_tmp)
+        raise
+
+def to_numpy(embeds):
+    embeds = embeds.detach().cpu()
+    if embeds.dtype == torch.bfloat16:
+        embeds = embeds.float()
+    return embeds.numpy()
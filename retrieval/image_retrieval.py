@@ -2,6 +2,7 @@ import torch
 from torch.utils.data import DataLoader
 from PIL import Image
 from tqdm import tqdm
+import functools
 import os
 import pickle
 import sys
@@ -10,17 +11,23 @@ import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from colpali_engine.models.paligemma_colbert_architecture import ColPali
-from colpali_engine.trainer.retrieval_evaluator import CustomEvaluator
 from colpali_engine.utils.colpali_processing_utils import process_images, process_queries
 from transformers import AutoProcessor
 
 from mydatasets.base_dataset import BaseDataset
+from mydatasets.page_store import load_image
 from retrieval.base_retrieval import BaseRetrieval
+from retrieval.compression import CompressedPages, compress, compression_tag, page_vectors
+from retrieval.embedding_store import EmbeddingStore
+from utils.profiler import profile_stage
 
 # 导入模型路径工具
 from utils.model_utils import get_model_path
 
 class ColpaliRetrieval(BaseRetrieval):
+    # Stores kept by find_samples_top_k between calls of a long-lived process.
+    search_stores = None
+    
     def __init__(self, config):
         self.config = config
         
@@ -80,92 +87,408 @@ class ColpaliRetrieval(BaseRetrieval):
             self.model.load_adapter(model_name)
             self.processor = AutoProcessor.from_pretrained(model_name)
     
-    def prepare(self, dataset: BaseDataset):
+    def prepare(self, dataset: BaseDataset, samples=None, force=False):
+        """:param force: Embed every document again, along with its compressed and page vector variants."""
         os.makedirs(self.config.embed_dir, exist_ok=True)
-        embed_path = self.config.embed_dir + "/" + dataset.config.name + "_embed.pkl"
-        if os.path.exists(embed_path):
-            with open(embed_path, "rb") as file:  # Use "rb" mode for binary reading
-                document_embeds = pickle.load(file)
-        else:
-            document_embeds = {}
+        document_embeds = self.open_embed_store(dataset)
         
-        samples = dataset.load_data(use_retreival=True)
-        for sample in tqdm(samples):
-            if sample[self.config.doc_key] in document_embeds:
+        # Documents still to embed, each once no matter how many samples refer to it.
+        documents = {}
+        for sample in samples if samples is not None else dataset.iter_samples(use_retreival=True):
+            doc_id = sample.get(self.config.doc_key)
+            if doc_id is None or doc_id in documents:
                 continue
-            content_list = dataset.load_processed_content(sample, disable_load_image=False)
-            images = [content.image for content in content_list]
-            dataloader = DataLoader(
-                images,
-                batch_size=self.config.batch_size,
-                shuffle=False,
-                collate_fn=lambda x: process_images(self.processor, x).to(self.model.device),
-            )
-            image_embeds = []
-            for batch_image in dataloader:
-                with torch.no_grad():
-                    batch_image = {k: v.to(self.model.device) for k, v in batch_image.items()}
-                    batch_image_embed = self.model(**batch_image)
-                    image_embeds.extend(batch_image_embed)
-            try:
-                document_embeds[sample[self.config.doc_key]] = torch.stack(image_embeds,axis=0)
-            except:
-                document_embeds[sample[self.config.doc_key]] = None
+            content_list = dataset.load_processed_content(sample)
+            if document_embeds.is_current(doc_id, content_list.fingerprint):
+                if not force:
+                    continue
+            elif doc_id in document_embeds:
+                print(f"Pages of {doc_id} changed, embed again.")
+            documents[doc_id] = content_list
+        
+        writers = {doc_id: document_embeds.writer(doc_id, len(content_list), fingerprint=content_list.fingerprint) for doc_id, content_list in documents.items()}
+        num_written = 0
+        for doc_id in list(writers):
+            if writers[doc_id].done:
+                writers.pop(doc_id).close()
                 print("Empty doc.")
+        # Every page is written to its document's file as soon as it is embedded.
+        try:
+            for keys, batch_embeds in self.embed_pages(dataset, documents):
+                for (doc_id, index), page_embed in zip(keys, batch_embeds):
+                    writer = writers[doc_id]
+                    writer.write(index, page_embed[None])
+                    if not writer.done:
+                        continue
+                    writers.pop(doc_id).close()
+                    num_written += 1
+                    # Persist the index every few documents, so a crash only loses the documents since the last checkpoint.
+                    if num_written % self.config.checkpoint_every == 0:
+                        document_embeds.flush()
+        except BaseException:
+            for writer in writers.values():
+                writer.abort()
+            raise
         
-        with open(embed_path, "wb") as f:
-            pickle.dump(document_embeds, f)
+        document_embeds.flush()
+        rebuilt = set(documents) if force else None
+        self.compress_embeds(dataset, document_embeds, rebuild=rebuilt)
+        self.build_page_vectors(dataset, document_embeds, rebuild=rebuilt)
             
         return document_embeds
+    
+    def embed_pages(self, dataset: BaseDataset, documents):
+        """
+        Embed the pages of many documents in shared, full batches. Page images are loaded and preprocessed
+        by retrieval.embed_workers worker processes (0 keeps it in this process). At most about
+        retrieval.max_images_in_flight pages are loaded or waiting for the model at any time.
+        :param documents: Dict from doc id to its DocumentContent.
+        :return: Generator of (keys, embeds) per batch, where keys holds a (doc_id, page index) pair per page.
+        """
+        pages = [(doc_id, index, content_list.image_path(index)) for doc_id, content_list in documents.items() for index in range(len(content_list))]
+        batch_size = min(self.config.batch_size, self.config.max_images_in_flight)
+        num_workers = self.config.embed_workers
+        # Each worker keeps prefetch_factor batches ready, on top of the batch the model is running.
+        prefetch_factor = max(1, (self.config.max_images_in_flight // batch_size - 1) // max(num_workers, 1))
+        dataloader = DataLoader(
+            PageImages(pages),
+            batch_size=batch_size,
+            shuffle=False,
+            num_workers=num_workers,
+            # Workers get only the page list and the preprocessing function, never the retriever or its model.
+            collate_fn=functools.partial(collate_pages, self.page_preprocessor()),
+            prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        )
+        with tqdm(total=len(pages)) as pbar:
+            for keys, batch_inputs in dataloader:
+                yield keys, self.embed_batch(batch_inputs)
+                pbar.update(len(keys))
+    
+    def page_preprocessor(self):
+        """Picklable function from page images to model inputs; it runs in the DataLoader workers."""
+        return functools.partial(process_images, self.processor)
+    
+    def preprocess_images(self, images):
+        return self.page_preprocessor()(images)
+    
+    def embed_batch(self, batch_inputs):
+        with torch.no_grad():
+            batch_inputs = {k: v.to(self.model.device) for k, v in batch_inputs.items()}
+            return self.model(**batch_inputs).cpu()
+    
+    def embed_images(self, images):
+        image_embeds = []
+        for start in range(0, len(images), self.config.batch_size):
+            image_embeds.extend(self.embed_batch(self.preprocess_images(images[start:start + self.config.batch_size])))
+        return image_embeds
+    
+    def embed_queries(self, queries):
+        # The processor needs an image next to every query, but it is never used; build it once.
+        if getattr(self, "mock_image", None) is None:
+            self.mock_image = Image.new("RGB", (448, 448), (255, 255, 255))
+        batch_queries = process_queries(self.processor, queries, self.mock_image).to(self.model.device)
+        with torch.no_grad():
+            return self.model(**batch_queries)
             
-    def find_sample_top_k(self, sample, document_embed, top_k: int, page_id_key: str):
-        query = [sample[self.config.image_question_key]]
-        batch_queries = process_queries(self.processor, query, Image.new("RGB", (448, 448), (255, 255, 255))).to(self.model.device)
-        with torch.no_grad():    
-            query_embed = self.model(**batch_queries)
-        
-        page_id_list = None
-        if page_id_key in sample:
-            page_id_list = sample[page_id_key]
-            assert isinstance(page_id_list, list)
-            
-        retriever_evaluator = CustomEvaluator(is_multi_vector=True)
-        scores = retriever_evaluator.evaluate(query_embed, document_embed)
+    def find_sample_top_k(self, sample, document_embed, top_k: int, page_id_key: str, compressed_embed=None, page_vector=None):
+        return self.find_batch_top_k([sample], document_embed, top_k, page_id_key, compressed_embed=compressed_embed, page_vector=page_vector)[0]
+    
+    @profile_stage("retrieval")
+    def find_batch_top_k(self, samples, document_embed, top_k: int, page_id_key: str, compressed_embed=None, rescore_k=None, page_vector=None):
+        """
+        Rank the pages of one document for several questions with a single query forward pass and MaxSim.
+        With compressed_embed, MaxSim runs on the compressed pages, and the best rescore_k of them are scored
+        again on document_embed (rescore_k=0 keeps the compressed ranking).
+        With page_vector (one pooled vector per page) and more than coarse_min_pages pages, MaxSim only runs on
+        the coarse_k pages whose pooled vectors score best.
+        top_k=None ranks every scored page: the coarse shortlist only, and with compression the best rescore_k
+        pages rescored followed by the others in compressed order. This full ranking does not depend on top_k.
+        :return: A (top_page_indices, top_page_scores) pair per sample.
+        """
+        if document_embed is None:
+            return [([], []) for _ in samples]
+        if rescore_k is None:
+            rescore_k = self.config.rescore_k
+        queries = [sample[self.config.image_question_key] for sample in samples]
+        query_embeds = self.embed_queries(queries)
+        page_id_lists = []
+        for sample in samples:
+            page_id_list = None
+            if page_id_key in sample:
+                page_id_list = sample[page_id_key]
+                assert isinstance(page_id_list, list)
+            page_id_lists.append(page_id_list)
         
-        if page_id_list:
-            scores_tensor = torch.tensor(scores)
-            mask = torch.zeros_like(scores_tensor, dtype=torch.bool)
-            for idx in page_id_list:
-                mask[0, idx] = True
-            masked_scores = torch.where(mask, scores_tensor, torch.full_like(scores_tensor, float('-inf')))
-            top_page = torch.topk(masked_scores, min(top_k, len(page_id_list)), dim=-1)
+        page_embeds = document_embed if compressed_embed is None else compressed_embed
+        use_coarse = page_vector is not None and self.config.coarse_k > 0 and len(page_vector) > self.config.coarse_min_pages
+        if use_coarse:
+            page_id_lists = coarse_shortlist(query_embeds, page_vector, page_id_lists, self.config.coarse_k)
+            # Each query only reads and scores its own shortlist; the other pages keep -inf.
+            scores = torch.full((len(samples), len(page_vector)), float("-inf"))
+            for row, page_id_list in enumerate(page_id_lists):
+                pages = torch.tensor(page_id_list, dtype=torch.long)
+                scores[row, pages] = colbert_scores(query_embeds[row:row + 1], page_embeds.index_select(0, pages))[0].cpu()
         else:
-            top_page = torch.topk(torch.tensor(scores), min(top_k,len(scores[0])), dim=-1)
-            
-        top_page_scores = top_page.values.tolist()[0] if top_page is not None else []
-        top_page_indices = top_page.indices.tolist()[0] if top_page is not None else []
+            scores = colbert_scores(query_embeds, page_embeds).cpu()
         
-        return top_page_indices, top_page_scores
+        head_k = rescore_k if top_k is None else max(rescore_k, top_k)
+        if top_k is None:
+            top_k = len(scores[0])
+        results = []
+        for row, (page_id_list, sample_scores) in enumerate(zip(page_id_lists, scores)):
+            if compressed_embed is not None and rescore_k > 0:
+                candidates, candidate_scores = rank_pages(sample_scores, page_id_list, max(head_k, top_k))
+                exact_scores = colbert_scores(query_embeds[row:row + 1], document_embed.index_select(0, candidates[:head_k]))[0].cpu()
+                top_page_indices, top_page_scores = rank_pages(exact_scores, None, head_k)
+                top_page_indices = torch.cat([candidates[:head_k][top_page_indices], candidates[head_k:]])[:top_k]
+                top_page_scores = torch.cat([top_page_scores, candidate_scores[head_k:]])[:top_k]
+            else:
+                top_page_indices, top_page_scores = rank_pages(sample_scores, page_id_list, top_k)
+            # Pages left out by the coarse stage keep -inf and are not part of the ranking.
+            scored = torch.isfinite(top_page_scores)
+            results.append((top_page_indices[scored].tolist(), top_page_scores[scored].tolist()))
+        return results
+        
+    def result_keys(self):
+        return [self.config.r_image_key]
         
     def find_top_k(self, dataset: BaseDataset, force_prepare=False):
-        document_embeds = self.load_document_embeds(dataset, force_prepare=force_prepare)
-        top_k = self.config.top_k
+        stores = self.load_search_stores(dataset, force_prepare=force_prepare)
         samples = dataset.load_data(use_retreival=True)
-        for sample in tqdm(samples):
-            if self.config.r_image_key in sample:
+        keys = self.ranking_keys(dataset, "image")
+        pending = []
+        for sample in samples:
+            if dataset.rankings is None and keys["result"] in sample:
+                continue
+            if self.load_ranking(dataset, sample, keys):
                 continue
-            document_embed = document_embeds[sample[self.config.doc_key]]
-            top_page_indices, top_page_scores = self.find_sample_top_k(sample, document_embed, top_k, dataset.config.page_id_key)
-            sample[self.config.r_image_key] = top_page_indices
-            sample[self.config.r_image_key+"_score"] = top_page_scores
+            pending.append(sample)
+        self.find_samples_top_k(dataset, pending, stores)
         path = dataset.dump_data(samples, use_retreival=True)
         print(f"Save retrieval results at {path}.")
+    
+    def find_samples_top_k(self, dataset: BaseDataset, samples, stores=None):
+        """
+        Rank the pages of the given samples and write their result keys like find_top_k.
+        Without stores, the stores are loaded once and kept, and only documents that are new or changed are embedded.
+        """
+        if stores is None:
+            if self.search_stores is None or not all(self.is_embedded(self.search_stores[0], dataset, sample) for sample in samples):
+                self.search_stores = self.load_search_stores(dataset, samples=samples)
+            stores = self.search_stores
+        document_embeds, compressed_embeds, page_vectors = stores
+        top_k = self.config.top_k
+        batch_size = self.config.query_batch_size
+        keys = self.ranking_keys(dataset, "image")
+        # Questions about the same document are encoded and scored together against its page tensor.
+        doc_samples = {}
+        for sample in samples:
+            doc_samples.setdefault(sample[self.config.doc_key], []).append(sample)
+        with tqdm(total=len(samples)) as pbar:
+            for doc_id, doc_sample_list in doc_samples.items():
+                document_embed = document_embeds[doc_id]
+                compressed_embed = self.load_compressed_embed(compressed_embeds, doc_id)
+                page_vector = page_vectors.get(doc_id) if page_vectors is not None else None
+                for start in range(0, len(doc_sample_list), batch_size):
+                    batch = doc_sample_list[start:start + batch_size]
+                    # Without a ranking store only the top_k pages are kept, as before.
+                    results = self.find_batch_top_k(batch, document_embed, top_k if dataset.rankings is None else None, keys["page_id"], compressed_embed=compressed_embed, page_vector=page_vector)
+                    for sample, (top_page_indices, top_page_scores) in zip(batch, results):
+                        self.save_ranking(dataset, sample, keys, top_page_indices, top_page_scores)
+                    pbar.update(len(batch))
+    
+    def compress_embeds(self, dataset: BaseDataset, document_embeds: EmbeddingStore, rebuild=None):
+        """
+        Build the compressed variant chosen by retrieval.compression and retrieval.pool_factor next to the full store.
+        Documents already compressed from the same pages are kept.
+        :return: The compressed store, or None when compression is off.
+        """
+        tag = compression_tag(self.config.compression, self.config.pool_factor)
+        if tag is None:
+            return None
+        compress_fn = lambda embeds: compress(embeds, self.config.compression, self.config.pool_factor)
+        return self.derive_embeds(document_embeds, tag, compress_fn, rebuild=rebuild, compression=self.config.compression)
+    
+    def build_page_vectors(self, dataset: BaseDataset, document_embeds: EmbeddingStore, rebuild=None):
+        """
+        Store one pooled vector per page for the coarse stage of find_batch_top_k. Only documents with more than
+        coarse_min_pages pages use the coarse stage, so shorter ones get no page vectors.
+        :return: The page vector store, or None when retrieval.coarse_k is 0.
+        """
+        if self.config.coarse_k <= 0:
+            return None
+        return self.derive_embeds(document_embeds, "pagevec", page_vectors, rebuild=rebuild, min_pages=self.config.coarse_min_pages + 1)
+    
+    def derive_embeds(self, document_embeds: EmbeddingStore, tag, derive_fn, rebuild=None, min_pages=0, **meta):
+        """
+        Keep <store>_<tag> in step with the full store, writing derive_fn(embeds) for every document with at least
+        min_pages pages. Documents already derived from the same pages are kept, except the doc ids in rebuild.
+        """
+        derived_embeds = EmbeddingStore(document_embeds.root + "_" + tag)
+        num_written = 0
+        for doc_id in tqdm(list(document_embeds.keys()), desc=tag):
+            fingerprint = document_embeds.index[doc_id].get("fingerprint")
+            shape = document_embeds.index[doc_id].get("shape")
+            if min_pages > 0 and (shape is None or shape[0] < min_pages):
+                # Drop entries derived before the document shrank, so they are never used for its new pages.
+                if doc_id in derived_embeds:
+                    derived_embeds.remove(doc_id)
+                    num_written += 1
+                continue
+            if derived_embeds.is_current(doc_id, fingerprint) and (rebuild is None or doc_id not in rebuild):
+                continue
+            document_embed = document_embeds[doc_id]
+            if document_embed is None:
+                derived_embeds.put(doc_id, None, fingerprint=fingerprint)
+            else:
+                # A slice of pages at a time, so memory stays bounded for very long documents.
+                writer = derived_embeds.writer(doc_id, len(document_embed), fingerprint=fingerprint, dim=document_embed.shape[-1], **meta)
+                try:
+                    for start in range(0, len(document_embed), self.config.max_images_in_flight):
+                        writer.write(start, derive_fn(document_embed[start:start + self.config.max_images_in_flight]))
+                except BaseException:
+                    writer.abort()
+                    raise
+                writer.close()
+            num_written += 1
+            if num_written % self.config.checkpoint_every == 0:
+                derived_embeds.flush()
+        derived_embeds.flush()
+        return derived_embeds
+    
+    def load_compressed_embed(self, compressed_embeds: EmbeddingStore, doc_id):
+        codes = compressed_embeds.get(doc_id) if compressed_embeds is not None else None
+        if codes is None:
+            return None
+        entry = compressed_embeds.index[doc_id]
+        return CompressedPages(codes, entry["compression"], entry["dim"])
+    
+    def compression_report(self, dataset: BaseDataset):
+        """
+        Compare the compressed variant with full-precision retrieval on the dataset's questions.
+        Recall@top_k is the share of the full-precision top_k pages that the compressed ranking also returns.
+        """
+        document_embeds = self.load_document_embeds(dataset)
+        compressed_embeds = self.compress_embeds(dataset, document_embeds)
+        if compressed_embeds is None:
+            raise ValueError("Set retrieval.compression or retrieval.pool_factor to compare a compressed variant.")
+        top_k = self.config.top_k
+        samples = dataset.load_data(use_retreival=True)
+        doc_samples = {}
+        for sample in samples:
+            doc_samples.setdefault(sample[self.config.doc_key], []).append(sample)
+        hits = {"compressed": 0, "rescored": 0}
+        total = 0
+        for doc_id, doc_sample_list in tqdm(doc_samples.items()):
+            document_embed = document_embeds[doc_id]
+            compressed_embed = self.load_compressed_embed(compressed_embeds, doc_id)
+            if document_embed is None:
+                continue
+            page_id_key = dataset.config.page_id_key
+            exact = self.find_batch_top_k(doc_sample_list, document_embed, top_k, page_id_key)
+            compressed = self.find_batch_top_k(doc_sample_list, document_embed, top_k, page_id_key, compressed_embed=compressed_embed, rescore_k=0)
+            rescored = self.find_batch_top_k(doc_sample_list, document_embed, top_k, page_id_key, compressed_embed=compressed_embed, rescore_k=max(self.config.rescore_k, top_k))
+            for (exact_pages, _), (compressed_pages, _), (rescored_pages, _) in zip(exact, compressed, rescored):
+                total += len(exact_pages)
+                hits["compressed"] += len(set(exact_pages) & set(compressed_pages))
+                hits["rescored"] += len(set(exact_pages) & set(rescored_pages))
+        full_bytes = document_embeds.nbytes()
+        compressed_bytes = compressed_embeds.nbytes()
+        return {
+            "variant": os.path.basename(compressed_embeds.root),
+            "top_k": top_k,
+            "rescore_k": max(self.config.rescore_k, top_k),
+            "full_bytes": full_bytes,
+            "compressed_bytes": compressed_bytes,
+            "storage_ratio": compressed_bytes / full_bytes if full_bytes else 0.0,
+            "recall": hits["compressed"] / total if total else 0.0,
+            "recall_rescored": hits["rescored"] / total if total else 0.0,
+        }
         
-    def load_document_embeds(self, dataset: BaseDataset, force_prepare=False):
+    def load_document_embeds(self, dataset: BaseDataset, force_prepare=False, samples=None):
+        """Embedding store, with the documents of samples (default: the dataset's) embedded first when needed."""
+        document_embeds = self.open_embed_store(dataset)
+        checked = samples if samples is not None else dataset.iter_samples(use_retreival=True)
+        if force_prepare or any(not self.is_embedded(document_embeds, dataset, sample) for sample in checked if self.config.doc_key in sample):
+            document_embeds = self.prepare(dataset, samples, force=force_prepare)
+        return document_embeds
+    
+    def load_search_stores(self, dataset: BaseDataset, force_prepare=False, samples=None):
+        """:return: The embedding store with its compressed and page vector variants (None when off)."""
+        document_embeds = self.load_document_embeds(dataset, force_prepare=force_prepare, samples=samples)
+        return document_embeds, self.compress_embeds(dataset, document_embeds), self.build_page_vectors(dataset, document_embeds)
+    
+    def is_embedded(self, document_embeds: EmbeddingStore, dataset: BaseDataset, sample):
+        if sample[self.config.doc_key] not in document_embeds:
+            return False
+        fingerprint = dataset.load_processed_content(sample).fingerprint
+        return document_embeds.is_current(sample[self.config.doc_key], fingerprint)
+    
+    def open_embed_store(self, dataset: BaseDataset):
+        os.makedirs(self.config.embed_dir, exist_ok=True)
+        store = EmbeddingStore(self.config.embed_dir + "/" + dataset.config.name + "_embeds")
+        # Move embeddings from the old single-pickle format into the store once.
         embed_path = self.config.embed_dir + "/" + dataset.config.name + "_embed.pkl"
-        if os.path.exists(embed_path) and not force_prepare:
+        if len(store) == 0 and os.path.exists(embed_path):
+            print(f"Convert {embed_path} into {store.root}.")
             with open(embed_path, "rb") as file:  # Use "rb" mode for binary reading
                 document_embeds = pickle.load(file)
-        else:
-            document_embeds = self.prepare(dataset)
-        return document_embeds
\ No newline at end of file
+            for doc_id, embeds in document_embeds.items():
+                store.put(doc_id, embeds)
+            store.flush()
+        return store
+
+class PageImages(torch.utils.data.Dataset):
+    """Page images of several documents, loaded on access so DataLoader workers do the decoding."""
+    def __init__(self, pages):
+        self.pages = pages
+    
+    def __len__(self):
+        return len(self.pages)
+    
+    def __getitem__(self, index):
+        doc_id, page_index, image_path = self.pages[index]
+        return (doc_id, page_index), load_image(image_path)
+
+def collate_pages(preprocess, batch):
+    # Runs in the DataLoader workers.
+    keys = [key for key, _ in batch]
+    return keys, preprocess([image for _, image in batch])
+
+def rank_pages(scores, page_id_list, top_k):
+    """Top pages of one score row, restricted to page_id_list when it is given."""
+    if page_id_list:
+        page_ids = torch.tensor(page_id_list, dtype=torch.long)
+        top_page = torch.topk(scores.index_select(0, page_ids), min(top_k, len(page_id_list)))
+        return page_ids[top_page.indices], top_page.values
+    top_page = torch.topk(scores, min(top_k, len(scores)))
+    return top_page.indices, top_page.values
+
+def coarse_shortlist(query_embeds, page_vector, page_id_lists, coarse_k):
+    """
+    Candidate pages per query from one matrix product between the summed query tokens and the pooled page vectors.
+    Zero (padding) query tokens add nothing to the sum.
+    """
+    query_vectors = torch.nn.functional.normalize(query_embeds.float().sum(dim=1), dim=-1)
+    scores = (query_vectors @ page_vector.to(query_vectors.device).float().T).cpu()
+    return [rank_pages(sample_scores, page_id_list, coarse_k)[0].tolist() for sample_scores, page_id_list in zip(scores, page_id_lists)]
+
+def colbert_scores(query_embeds, page_embeds):
+    """
+    MaxSim scores of shape (num_queries, num_pages), as computed by CustomEvaluator.evaluate_colbert,
+    but on the device the embeddings already live on (the evaluator hard-codes cuda).
+    """
+    if isinstance(query_embeds, torch.Tensor):
+        qs = query_embeds.float()
+    else:
+        qs = torch.nn.utils.rnn.pad_sequence(list(query_embeds), batch_first=True, padding_value=0).float()
+    if isinstance(page_embeds, CompressedPages):
+        if len(page_embeds) == 0:
+            return torch.zeros((len(qs), 0), device=qs.device)
+        return torch.cat([colbert_scores(qs, chunk) for chunk in page_embeds.chunks()], dim=1)
+    # A stored document is already one (pages, tokens, dim) tensor; only lists of pages need padding.
+    if isinstance(page_embeds, torch.Tensor):
+        ps = page_embeds.to(qs.device).float()
+    else:
+        ps = torch.nn.utils.rnn.pad_sequence(list(page_embeds), batch_first=True, padding_value=0).to(qs.device).float()
+    return torch.einsum("bnd,csd->bcns", qs, ps).max(dim=3)[0].sum(dim=2)
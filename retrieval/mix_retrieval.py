@@ -0,0 +1,80 @@
+import numpy as np
+from tqdm import tqdm
+
+from retrieval.base_retrieval import BaseRetrieval
+from mydatasets.base_dataset import BaseDataset
+
+class FusionRetrieval(BaseRetrieval):
+    """
+    Mix ranking from the text and image rankings already in the samples, without running ColBERT or ColPali again.
+    Candidates are the union of the text and image top_k pages. They are ranked either by reciprocal rank fusion
+    or by a weighted sum of min-max normalized scores, using the full stored rankings when they are available.
+    The result goes to r_mix_key, which dataset.use_mix reads.
+    """
+    def __init__(self, config):
+        self.config = config
+
+    def load_side(self, dataset: BaseDataset, sample, keys):
+        """Pages and scores of one retriever: its full stored ranking, else the top_k pages in the sample."""
+        if dataset.rankings is not None and keys["ranking"] in sample:
+            ranking = dataset.rankings.get(*sample[keys["ranking"]])
+            if ranking is not None:
+                return ranking
+        return sample.get(keys["result"], []), sample.get(keys["result"]+"_score", [])
+
+    def fuse(self, sides, candidates):
+        """
+        :param sides: (pages, scores, weight) per retriever.
+        :return: (pages, scores) of the candidates ordered by fused score; ties keep the candidate order.
+        """
+        candidates = np.asarray(candidates, dtype=np.int64)
+        fused = np.zeros(len(candidates), dtype=np.float32)
+        if len(candidates) == 0:
+            return [], []
+        num_pages = max([candidates.max()] + [max(pages) for pages, _, _ in sides if len(pages)]) + 1
+        for pages, scores, weight in sides:
+            if not len(pages):
+                continue
+            pages = np.asarray(pages, dtype=np.int64)
+            if self.config.fusion == "rrf":
+                values = 1.0 / (self.config.rrf_k + np.arange(1, len(pages) + 1, dtype=np.float32))
+            else:
+                scores = np.asarray(scores, dtype=np.float32)
+                spread = scores.max() - scores.min()
+                values = (scores - scores.min()) / spread if spread > 0 else np.ones_like(scores)
+            # Pages missing from a ranking add nothing; a page listed twice keeps its best rank.
+            dense = np.zeros(num_pages, dtype=np.float32)
+            dense[pages[::-1]] = values[::-1]
+            fused += weight * dense[candidates]
+        order = np.argsort(-fused, kind="stable")
+        return candidates[order].tolist(), fused[order].tolist()
+
+    def find_samples_top_k(self, dataset: BaseDataset, samples):
+        """Fuse the rankings of the given samples and write their mix keys. :return: Number of samples without any ranking."""
+        if self.config.fusion not in ("rrf", "score"):
+            raise ValueError(f"Unknown fusion {self.config.fusion}, expected rrf or score")
+        text_keys = self.ranking_keys(dataset, "text")
+        image_keys = self.ranking_keys(dataset, "image")
+        mix_keys = self.ranking_keys(dataset, "mix")
+        text_weight, image_weight = self.config.text_weight, self.config.image_weight
+        missing = 0
+        for sample in tqdm(samples):
+            if text_keys["result"] not in sample and image_keys["result"] not in sample:
+                missing += 1
+                continue
+            candidates = list(dict.fromkeys(sample.get(text_keys["result"], []) + sample.get(image_keys["result"], [])))
+            sides = [(*self.load_side(dataset, sample, text_keys), text_weight), (*self.load_side(dataset, sample, image_keys), image_weight)]
+            top_page_indices, top_page_scores = self.fuse(sides, candidates)
+            self.save_ranking(dataset, sample, mix_keys, top_page_indices, top_page_scores)
+        return missing
+
+    def result_keys(self):
+        return [self.config.r_mix_key]
+
+    def find_top_k(self, dataset: BaseDataset, force_prepare=False):
+        samples = dataset.load_data(use_retreival=True)
+        missing = self.find_samples_top_k(dataset, samples)
+        if missing:
+            print(f"{missing} samples have neither {self.config.r_text_key} nor {self.config.r_image_key}; run text and image retrieval first.")
+        path = dataset.dump_data(samples, use_retreival=True)
+        print(f"Save retrieval results at {path}.")
@@ -0,0 +1,80 @@
+import copy
+import json
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from mydatasets.base_dataset import BaseDataset
+
+class RetrievalServer(ThreadingHTTPServer):
+    """
+    Keeps retrievers (their models, embedding stores and searchers) loaded across requests and serves them over
+    HTTP on localhost. Requests are handled one at a time, as the retrievers share the model device.
+    Endpoints, all JSON:
+        GET  /health                                  -> {"dataset": name, "retrievals": [names], "keys": {name: [result keys]}}
+        POST /find_top_k {"samples", "retrievals"}    -> {"updates": [keys added or changed per sample]}
+        POST /run {"retrieval"}                       -> {"path": saved samples}, find_top_k over the whole dataset
+    """
+    daemon_threads = True
+
+    def __init__(self, address, dataset: BaseDataset, retrievals: dict):
+        super().__init__(address, RetrievalHandler)
+        self.dataset = dataset
+        self.retrievals = retrievals
+        self.lock = threading.Lock()
+
+    def health(self):
+        return {"dataset": self.dataset.config.name, "retrievals": list(self.retrievals), "keys": {name: retrieval.result_keys() for name, retrieval in self.retrievals.items()}}
+
+    def find_top_k(self, samples, retrievals=None):
+        names = retrievals or list(self.retrievals)
+        for name in names:
+            if name not in self.retrievals:
+                raise KeyError(f"Unknown retrieval {name}, expected one of {list(self.retrievals)}")
+        originals = copy.deepcopy(samples)
+        with self.lock:
+            for name in names:
+                self.retrievals[name].find_samples_top_k(self.dataset, samples)
+            # Clients read the rankings referenced by the updates from the same store.
+            if self.dataset.rankings is not None:
+                self.dataset.rankings.flush()
+        return {"updates": [{key: value for key, value in sample.items() if original.get(key) != value} for sample, original in zip(samples, originals)]}
+
+    def run(self, retrieval):
+        with self.lock:
+            self.retrievals[retrieval].find_top_k(self.dataset)
+        return {"path": self.dataset.config.sample_with_retrieval_path}
+
+class RetrievalHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/health":
+            return self.reply(404, {"error": f"Unknown path {self.path}"})
+        self.reply(200, self.server.health())
+
+    def do_POST(self):
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if self.path == "/find_top_k":
+                result = self.server.find_top_k(payload["samples"], payload.get("retrievals"))
+            elif self.path == "/run":
+                result = self.server.run(payload["retrieval"])
+            else:
+                return self.reply(404, {"error": f"Unknown path {self.path}"})
+        except (KeyError, ValueError, NotImplementedError) as e:
+            return self.reply(400, {"error": f"{type(e).__name__}: {e}"})
+        except Exception as e:
+            traceback.print_exc()
+            return self.reply(500, {"error": f"{type(e).__name__}: {e}"})
+        self.reply(200, result)
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Requests are frequent; only errors are printed.
+        pass
@@ -1,5 +1,6 @@
 import os
 import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 from ragatouille import RAGPretrainedModel
 
@@ -10,17 +11,34 @@ from fix_adamw_patch import *
 
 from retrieval.base_retrieval import BaseRetrieval
 from mydatasets.base_dataset import BaseDataset
+from utils.lru_cache import LRUCache
+from utils.profiler import profile_stage, profiler
 
 # 导入模型路径工具
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from utils.model_utils import get_model_path
 
+# Pages in a shared index are named <doc_id>::<page>.
+PAGE_ID_SEP = "::"
+# Fingerprints of the documents in a shared index, written next to its files.
+FINGERPRINT_FILE = "doc_fingerprints.json"
+
 class ColbertRetrieval(BaseRetrieval):
     def __init__(self, config):
         self.config = config
+        self.searchers = LRUCache(max_items=config.searcher_cache_size)
     
-    def prepare(self, dataset: BaseDataset):
-        samples = dataset.load_data(use_retreival=True)
+    def __getstate__(self):
+        # Index workers get a copy without the loaded searchers.
+        state = dict(self.__dict__)
+        del state["searchers"]
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.searchers = LRUCache(max_items=self.config.searcher_cache_size)
+    
+    def load_model(self):
         # 使用本地模型路径
         try:
             colbert_model_path = get_model_path('colbert')
@@ -30,6 +48,48 @@ class ColbertRetrieval(BaseRetrieval):
             print(f"加载本地ColBERT模型失败: {e}")
             print("尝试使用在线模型...")
             RAG = RAGPretrainedModel.from_pretrained("colbert-ir/colbertv2.0")
+        return RAG
+    
+    def load_searcher(self, index_path):
+        return RAGPretrainedModel.from_index(index_path)
+    
+    def load_index(self, index_path):
+        """Searcher and passage id -> page map of an index, kept in an LRU cache across samples."""
+        load_map = self.load_page_map if self.config.index_mode == "dataset" else self.load_pid_map
+        return self.searchers.get_or_load(index_path, lambda: (self.load_searcher(index_path), load_map(index_path)))
+    
+    def load_pid_map(self, index_path):
+        with open(index_path+"/pid_docid_map.json",'r') as f:
+            pid_map_data = json.load(f)
+        unique_values = list(dict.fromkeys(pid_map_data.values()))
+        value_to_rank = {val: idx for idx, val in enumerate(unique_values)}
+        return {int(key): value_to_rank[value] for key, value in pid_map_data.items()}
+    
+    def load_page_map(self, index_path):
+        """
+        Maps of a shared index: "pages" from passage id to (doc_id, page), "passages" from page name to
+        its number of passages (a long page can be split into several) and "doc_pages" from doc_id to its pages.
+        """
+        with open(index_path+"/pid_docid_map.json",'r') as f:
+            pid_map_data = json.load(f)
+        pages = {}
+        passages = {}
+        doc_pages = {}
+        for key, value in pid_map_data.items():
+            doc_id, page = value.rsplit(PAGE_ID_SEP, 1)
+            pages[int(key)] = (doc_id, int(page))
+            if value not in passages:
+                doc_pages.setdefault(doc_id, []).append(int(page))
+            passages[value] = passages.get(value, 0) + 1
+        return {"pages": pages, "passages": passages, "doc_pages": doc_pages}
+    
+    def prepare(self, dataset: BaseDataset):
+        if self.config.index_mode == "dataset":
+            return self.prepare_shared(dataset)
+        if self.config.index_workers > 1:
+            return self.prepare_parallel(dataset)
+        samples = dataset.load_data(use_retreival=True)
+        RAG = self.load_model()
         doc_index:dict = {}
         error = 0
         for sample in tqdm(samples):
@@ -56,19 +116,101 @@ class ColbertRetrieval(BaseRetrieval):
         dataset.dump_data(samples, use_retreival = True)
         
         return samples
+    
+    def prepare_parallel(self, dataset: BaseDataset):
+        """
+        Build per-document indexes in retrieval.index_workers processes, each loading the model once.
+        A failing document only leaves its own samples without an index; index paths are written to the
+        samples here in the main process once all builds are done.
+        """
+        samples = dataset.load_data(use_retreival=True)
+        doc_samples = {}
+        for sample in samples:
+            if self.config.r_text_index_key in sample and os.path.exists(sample[self.config.r_text_index_key]):
+                continue
+            doc_samples.setdefault(sample[self.config.doc_key], []).append(sample)
+        
+        tasks = []
+        for doc_id, doc_sample_list in doc_samples.items():
+            content_list = dataset.load_processed_content(doc_sample_list[0])
+            text = [content.txt.replace("\n", "") for content in content_list]
+            tasks.append((doc_id, dataset.config.name+ "-" + self.config.text_question_key + "-" + doc_id, text))
+        
+        error = 0
+        num_workers = min(self.config.index_workers, max(len(tasks), 1))
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=init_index_worker, initargs=(self, num_workers)) as executor:
+            futures = {executor.submit(index_document, *task): task[0] for task in tasks}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                doc_id = futures[future]
+                try:
+                    index_path = future.result()
+                except Exception as e:
+                    # Also covers a worker that died, which fails the documents it had not finished.
+                    print(f"Error processing {doc_id}: {e}")
+                    index_path = ""
+                    error += len(doc_samples[doc_id])
+                for sample in doc_samples[doc_id]:
+                    sample[self.config.r_text_index_key] = index_path
+        
+        dataset.dump_data(samples, use_retreival = True)
+        if error>len(samples)/100:
+            print("Too many error cases. Exit process.")
+            sys.exit(1)
+        
+        return samples
+    
+    def prepare_shared(self, dataset: BaseDataset):
+        """
+        Index every page of the dataset once, named <doc_id>::<page> with doc_id and page as metadata.
+        Searches are restricted to a sample's document (and page_ids) at query time. The index is built again
+        when a document is new or its pages changed since it was indexed.
+        """
+        samples = dataset.load_data(use_retreival=True)
+        documents = {}
+        for sample in samples:
+            if sample[self.config.doc_key] not in documents:
+                documents[sample[self.config.doc_key]] = dataset.load_processed_content(sample)
+        
+        fingerprints = {doc_id: content_list.fingerprint for doc_id, content_list in documents.items()}
+        index_paths = {sample.get(self.config.r_text_index_key) for sample in samples}
+        if len(index_paths) == 1:
+            index_path = index_paths.pop()
+            if index_path and os.path.exists(index_path+"/"+FINGERPRINT_FILE):
+                with open(index_path+"/"+FINGERPRINT_FILE, 'r') as f:
+                    indexed = json.load(f)
+                changed = [doc_id for doc_id, fingerprint in fingerprints.items() if indexed.get(doc_id) != fingerprint]
+                if not changed:
+                    return samples
+                print(f"Pages of {len(changed)} documents are new or changed, index again.")
+        
+        collection, document_ids, document_metadatas = [], [], []
+        for doc_id, content_list in documents.items():
+            for page in range(len(content_list)):
+                collection.append(content_list.txt(page).replace("\n", ""))
+                document_ids.append(f"{doc_id}{PAGE_ID_SEP}{page}")
+                document_metadatas.append({"doc_id": doc_id, "page": page})
+        RAG = self.load_model()
+        index_path = RAG.index(index_name=dataset.config.name + "-" + self.config.text_question_key, collection=collection, document_ids=document_ids, document_metadatas=document_metadatas)
+        with open(index_path+"/"+FINGERPRINT_FILE, 'w') as f:
+            json.dump(fingerprints, f)
+        # An index rebuilt at the same path must not be served from the cache.
+        self.searchers.clear()
+        for sample in samples:
+            sample[self.config.r_text_index_key] = index_path
+        dataset.dump_data(samples, use_retreival = True)
+        
+        return samples
 
+    @profile_stage("retrieval")
     def find_sample_top_k(self, sample, top_k: int, page_id_key: str):
+        if self.config.index_mode == "dataset":
+            return self.find_shared_sample_top_k(sample, top_k, page_id_key)
         if not os.path.exists(sample[self.config.r_text_index_key]+"/pid_docid_map.json"):
             print(f"Index not found for {sample[self.config.r_text_index_key]}/pid_docid_map.json.")
             return [], []
-        with open(sample[self.config.r_text_index_key]+"/pid_docid_map.json",'r') as f:
-            pid_map_data = json.load(f)
-        unique_values = list(dict.fromkeys(pid_map_data.values()))
-        value_to_rank = {val: idx for idx, val in enumerate(unique_values)}
-        pid_map = {int(key): value_to_rank[value] for key, value in pid_map_data.items()}
+        RAG, pid_map = self.load_index(sample[self.config.r_text_index_key])
         
         query = sample[self.config.text_question_key]
-        RAG = RAGPretrainedModel.from_index(sample[self.config.r_text_index_key])
         results = RAG.search(query, k=len(pid_map))
         
         top_page_indices = [pid_map[page['passage_id']] for page in results]
@@ -86,17 +228,86 @@ class ColbertRetrieval(BaseRetrieval):
             return filtered_indices[:top_k], filtered_scores[:top_k]
         
         return top_page_indices[:top_k], top_page_scores[:top_k]
+    
+    def find_shared_sample_top_k(self, sample, top_k: int, page_id_key: str):
+        if not os.path.exists(sample[self.config.r_text_index_key]+"/pid_docid_map.json"):
+            print(f"Index not found for {sample[self.config.r_text_index_key]}/pid_docid_map.json.")
+            return [], []
+        RAG, page_map = self.load_index(sample[self.config.r_text_index_key])
         
+        if page_id_key in sample:
+            page_id_list = sample[page_id_key]
+            assert isinstance(page_id_list, list)
+        else:
+            page_id_list = page_map["doc_pages"].get(sample[self.config.doc_key], [])
+        doc_ids = [name for name in dict.fromkeys(f"{sample[self.config.doc_key]}{PAGE_ID_SEP}{page}" for page in page_id_list) if name in page_map["passages"]]
+        if not doc_ids:
+            return [], []
+        
+        query = sample[self.config.text_question_key]
+        results = RAG.search(query, k=sum(page_map["passages"][name] for name in doc_ids), doc_ids=doc_ids)
+        
+        top_page_indices = [page_map["pages"][page['passage_id']][1] for page in results]
+        top_page_scores = [page['score'] for page in results]
+        return top_page_indices[:top_k], top_page_scores[:top_k]
+        
+    def find_samples_top_k(self, dataset: BaseDataset, samples, indices=None):
+        """
+        Search the given samples and write their result keys like find_top_k. indices are the sample numbers
+        used in the profile. Samples without an index path get the one of their document, indexing it if needed.
+        """
+        if indices is None:
+            indices = list(range(len(samples)))
+        self.fill_index_paths(dataset, samples)
+        keys = self.ranking_keys(dataset, "text")
+        top_k = self.config.top_k if dataset.rankings is None else None
+        # Samples of the same index are searched one after another, so each index is loaded once.
+        index_samples = {}
+        for index, sample in zip(indices, samples):
+            index_samples.setdefault(sample[self.config.r_text_index_key], []).append((index, sample))
+        with tqdm(total=len(samples)) as pbar:
+            for index_sample_list in index_samples.values():
+                for index, sample in index_sample_list:
+                    with profiler.sample(index):
+                        # The full ranking goes to the ranking store; save_ranking keeps top_k of it in the sample.
+                        top_page_indices, top_page_scores = self.find_sample_top_k(sample, top_k=top_k, page_id_key=keys["page_id"])
+                    self.save_ranking(dataset, sample, keys, top_page_indices, top_page_scores)
+                    pbar.update(1)
+    
+    def fill_index_paths(self, dataset: BaseDataset, samples):
+        missing = [sample for sample in samples if self.config.r_text_index_key not in sample]
+        if not missing:
+            return
+        load_index_paths = lambda: {sample[self.config.doc_key]: sample[self.config.r_text_index_key] for sample in dataset.iter_samples(use_retreival=True) if self.config.r_text_index_key in sample}
+        index_paths = load_index_paths()
+        if any(sample[self.config.doc_key] not in index_paths for sample in missing):
+            self.prepare(dataset)
+            index_paths = load_index_paths()
+        for sample in missing:
+            sample[self.config.r_text_index_key] = index_paths.get(sample[self.config.doc_key], "")
+    
+    def result_keys(self):
+        return [self.config.r_text_key]
+    
     def find_top_k(self, dataset: BaseDataset, force_prepare=False):
-        top_k = self.config.top_k
         samples = dataset.load_data(use_retreival=True)
         
-        if self.config.r_text_index_key not in samples[0] or force_prepare:
+        if self.config.r_text_index_key not in samples[0] or force_prepare or self.config.index_mode == "dataset":
             samples = self.prepare(dataset)
                 
-        for sample in tqdm(samples):
-            top_page_indices, top_page_scores = self.find_sample_top_k(sample, top_k=top_k, page_id_key = dataset.config.page_id_key)
-            sample[self.config.r_text_key] = top_page_indices
-            sample[self.config.r_text_key+"_score"] = top_page_scores
+        keys = self.ranking_keys(dataset, "text")
+        indices = [index for index, sample in enumerate(samples) if not self.load_ranking(dataset, sample, keys)]
+        self.find_samples_top_k(dataset, [samples[index] for index in indices], indices)
+        print(f"Searcher cache: {self.searchers.stats()}")
         path = dataset.dump_data(samples, use_retreival=True)
-        print(f"Save retrieval results at {path}.")
\ No newline at end of file
+        print(f"Save retrieval results at {path}.")
+_worker_model = {}
+
+def init_index_worker(retrieval, num_workers):
+    import torch
+    # Share the cores between the workers instead of letting each one use all of them.
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_workers))
+    _worker_model["RAG"] = retrieval.load_model()
+
+def index_document(doc_id, index_name, collection):
+    return _worker_model["RAG"].index(index_name=index_name, collection=collection)
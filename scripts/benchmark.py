@@ -0,0 +1,198 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# 应用AdamW补丁
+from fix_adamw_patch import *
+
+import argparse
+import json
+import resource
+import shutil
+import statistics
+import time
+from datetime import datetime
+from hydra import compose, initialize_config_dir
+from omegaconf import OmegaConf
+
+from benchmarks.synthetic import make_corpus
+from benchmarks.stubs import TinyColpaliRetrieval, TinyColbertRetrieval, TinyCorpusRetrieval
+from retrieval.bm25_retrieval import BM25Retrieval
+from retrieval.mix_retrieval import FusionRetrieval
+from mydatasets.base_dataset import BaseDataset
+from agents.mdoc_agent import MDocAgent
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux; extraction workers are counted through RUSAGE_CHILDREN.
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+def load_configs(work_dir, args):
+    data_dir = os.path.join(work_dir, "data")
+    overrides = [
+        "+dataset=base",
+        "dataset.name=synthetic",
+        "run-name=benchmark",
+        f"dataset.data_dir={data_dir}",
+        f"dataset.document_path={data_dir}/documents",
+        f"dataset.extract_path={work_dir}/extract",
+        f"dataset.result_dir={work_dir}/results",
+        f"dataset.extract_workers={args.workers}",
+        f"dataset.top_k={args.top_k}",
+        f"mdoc_agent.truncate_len=null",
+        # The optional features the benchmark measures, off by default in the configs.
+        "dataset.sort_by_document=true",
+        "mdoc_agent.use_journal=true",
+        "dataset.ranking_path=${dataset.data_dir}/rankings.sqlite",
+        f"dataset.profile_dir={work_dir}/results/profile",
+        f"mdoc_agent.batch_samples={args.batch_samples}",
+        f"mdoc_agent.concurrent_agents={args.concurrent_agents}",
+    ]
+    with initialize_config_dir(config_dir=os.path.join(PROJECT_ROOT, "config"), version_base="1.2"):
+        cfg = compose(config_name="base", overrides=overrides + ["retrieval=image", f"retrieval.embed_dir={work_dir}/embed", f"retrieval.embed_workers={args.embed_workers}"])
+        text_cfg = compose(config_name="base", overrides=overrides + ["retrieval=text", f"retrieval.index_mode={args.text_index_mode}", f"retrieval.index_workers={args.index_workers}"])
+        corpus_cfg = compose(config_name="base", overrides=overrides + ["retrieval=corpus", f"retrieval.embed_dir={work_dir}/embed", "retrieval.num_centroids=64"])
+        bm25_cfg = compose(config_name="base", overrides=overrides + ["retrieval=bm25"])
+        mix_cfg = compose(config_name="base", overrides=overrides + ["retrieval=mix"])
+        OmegaConf.set_struct(cfg, False)
+        model_cfg = OmegaConf.create({"module_name": "benchmarks.stubs", "class_name": "StubModel", "latency": args.latency, "batch_size": args.model_batch_size, "max_new_tokens": 16, "temperature": 0})
+        for agent_config in cfg.mdoc_agent.agents:
+            agent_config.agent = compose(config_name="agent/"+agent_config.agent, overrides=[]).agent
+            agent_config.model = model_cfg
+        cfg.mdoc_agent.sum_agent.agent = compose(config_name="agent/"+cfg.mdoc_agent.sum_agent.agent, overrides=[]).agent
+        cfg.mdoc_agent.sum_agent.model = model_cfg
+    return cfg, text_cfg, corpus_cfg, bm25_cfg, mix_cfg
+
+def timed(results, name, fn, amount, unit):
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    results[name] = {"seconds": seconds, "amount": amount, "throughput": amount / seconds if seconds > 0 else 0.0, "unit": unit, "peak_rss_mb": peak_rss_mb()}
+    print(f"{name:<24}{seconds:>10.3f} s{results[name]['throughput']:>12.2f} {unit}")
+
+def run(args):
+    work_dir = os.path.abspath(args.work_dir)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    cfg, text_cfg, corpus_cfg, bm25_cfg, mix_cfg = load_configs(work_dir, args)
+    sample_path, num_pages = make_corpus(cfg.dataset.data_dir, num_docs=args.docs, pages_per_doc=args.pages, questions_per_doc=args.questions, seed=args.seed)
+    num_samples = args.docs * min(args.questions, args.pages)
+    
+    dataset = BaseDataset(cfg.dataset)
+    image_retrieval = TinyColpaliRetrieval(cfg.retrieval)
+    corpus_retrieval = TinyCorpusRetrieval(corpus_cfg.retrieval)
+    bm25_retrieval = BM25Retrieval(bm25_cfg.retrieval)
+    mix_retrieval = FusionRetrieval(mix_cfg.retrieval)
+    text_retrieval = TinyColbertRetrieval(text_cfg.retrieval, index_root=os.path.join(work_dir, "indexes"))
+    mdoc_agent = MDocAgent(cfg.mdoc_agent)
+    
+    stages = {}
+    timed(stages, "extract_content", dataset.extract_content, num_pages, "pages/s")
+    timed(stages, "colpali_prepare", lambda: image_retrieval.prepare(dataset), num_pages, "pages/s")
+    timed(stages, "colpali_find_top_k", lambda: image_retrieval.find_top_k(dataset), num_samples, "queries/s")
+    timed(stages, "corpus_find_top_k", lambda: corpus_retrieval.find_top_k(dataset), num_samples, "queries/s")
+    # BM25 writes the same r_text_key as ColBERT, which runs after it and overwrites the results.
+    timed(stages, "bm25_find_top_k", lambda: bm25_retrieval.find_top_k(dataset), num_samples, "queries/s")
+    timed(stages, "colbert_prepare", lambda: text_retrieval.prepare(dataset), num_pages, "pages/s")
+    timed(stages, "colbert_find_top_k", lambda: text_retrieval.find_top_k(dataset), num_samples, "queries/s")
+    timed(stages, "fusion_find_top_k", lambda: mix_retrieval.find_top_k(dataset), num_samples, "queries/s")
+    timed(stages, "predict_dataset", lambda: mdoc_agent.predict_dataset(dataset), num_samples, "samples/s")
+    
+    return {
+        "time": datetime.now().strftime("%Y-%m-%d-%H-%M"),
+        "params": {k: v for k, v in vars(args).items() if k in ("docs", "pages", "questions", "latency", "batch_samples", "concurrent_agents", "model_batch_size", "workers", "embed_workers", "text_index_mode", "index_workers", "top_k", "seed", "repeat")},
+        "stages": stages,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def merge_runs(runs):
+    """Median time of every stage over repeated runs, since a single run of a short stage is mostly noise."""
+    stages = {}
+    for name, stage in runs[0]["stages"].items():
+        seconds = [run["stages"][name]["seconds"] for run in runs]
+        median = statistics.median(seconds)
+        stages[name] = {
+            "seconds": median,
+            "amount": stage["amount"],
+            "throughput": stage["amount"] / median if median > 0 else 0.0,
+            "unit": stage["unit"],
+            "runs": seconds,
+            "peak_rss_mb": max(run["stages"][name]["peak_rss_mb"] for run in runs),
+        }
+    results = dict(runs[-1])
+    results["stages"] = stages
+    results["peak_rss_mb"] = max(run["peak_rss_mb"] for run in runs)
+    return results
+
+def compare(results, baseline, tolerance, min_seconds):
+    """
+    Print throughput ratios against the baseline. Stages that took less than min_seconds in the baseline are
+    shown but never flagged, because their timings vary more than the tolerance between identical runs.
+    :return: Names of stages slower than (1 - tolerance) x baseline.
+    """
+    if baseline["params"] != results["params"]:
+        print(f"Warning: baseline was recorded with different parameters {baseline['params']}.")
+    regressions = []
+    print(f"{'stage':<24}{'baseline':>12}{'current':>12}{'ratio':>8}")
+    for name, stage in results["stages"].items():
+        if name not in baseline["stages"]:
+            continue
+        reference = baseline["stages"][name]["throughput"]
+        ratio = stage["throughput"] / reference if reference > 0 else float("inf")
+        flag = ""
+        if baseline["stages"][name]["seconds"] < min_seconds:
+            flag = "  (too short to compare)"
+        elif ratio < 1 - tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<24}{reference:>12.2f}{stage['throughput']:>12.2f}{ratio:>8.2f}{flag}")
+    print(f"Peak RSS: {results['peak_rss_mb']:.1f} MB (baseline {baseline['peak_rss_mb']:.1f} MB)")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark with synthetic PDFs and stub models.")
+    parser.add_argument("--work-dir", default=os.path.join(PROJECT_ROOT, "tmp", "benchmark"))
+    parser.add_argument("--docs", type=int, default=8)
+    parser.add_argument("--pages", type=int, default=24)
+    parser.add_argument("--questions", type=int, default=4, help="Questions per document")
+    parser.add_argument("--latency", type=float, default=0.01, help="Seconds per stub model call")
+    parser.add_argument("--batch-samples", type=int, default=1, help="Samples advanced together by the stage scheduler (mdoc_agent.batch_samples)")
+    parser.add_argument("--concurrent-agents", action="store_true", help="Run the text and image agents together (mdoc_agent.concurrent_agents)")
+    parser.add_argument("--model-batch-size", type=int, default=4, help="Conversations per stub model call in predict_batch")
+    parser.add_argument("--workers", type=int, default=1, help="dataset.extract_workers")
+    parser.add_argument("--embed-workers", type=int, default=0, help="retrieval.embed_workers")
+    parser.add_argument("--index-workers", type=int, default=1, help="retrieval.index_workers for ColBERT")
+    parser.add_argument("--text-index-mode", default="document", choices=["document", "dataset"], help="retrieval.index_mode for ColBERT")
+    parser.add_argument("--top-k", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Defaults to benchmarks/results/<time>.json")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of the whole pipeline; every stage reports its median time")
+    parser.add_argument("--baseline", default=os.path.join(PROJECT_ROOT, "benchmarks", "baseline.json"), help="Machine-specific, so it is not checked in")
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative throughput drop")
+    parser.add_argument("--min-seconds", type=float, default=0.5, help="Stages faster than this in the baseline are not checked for regressions")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+    
+    results = merge_runs([run(args) for _ in range(max(args.repeat, 1))])
+    output = args.output or os.path.join(PROJECT_ROOT, "benchmarks", "results", results["time"] + ".json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"Save benchmark results to {output}.")
+    
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.min_seconds)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=4)
+        print(f"Save baseline to {args.baseline}.")
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
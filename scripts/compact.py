@@ -0,0 +1,16 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from mydatasets.base_dataset import BaseDataset
+import hydra
+
+@hydra.main(config_path="../config", config_name="base", version_base="1.2")
+def main(cfg):
+    dataset = BaseDataset(cfg.dataset)
+    journal_path = cfg.get('journal_path', None) or dataset.find_latest_journal()
+    assert journal_path is not None, f"No journal found in {cfg.dataset.result_dir}"
+    path = dataset.compact_results(journal_path)
+    print(f"Compact {journal_path} into {path}.")
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
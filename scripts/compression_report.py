@@ -0,0 +1,26 @@
+import os
+import sys
+import json
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# 应用AdamW补丁
+from fix_adamw_patch import *
+
+from mydatasets.base_dataset import BaseDataset
+from retrieval.image_retrieval import ColpaliRetrieval
+import hydra
+
+@hydra.main(config_path="../config", config_name="base", version_base="1.2")
+def main(cfg):
+    os.environ["CUDA_VISIBLE_DEVICES"] = cfg.retrieval.cuda_visible_devices
+    dataset = BaseDataset(cfg.dataset)
+    retrieval_model = ColpaliRetrieval(cfg.retrieval)
+    report = retrieval_model.compression_report(dataset)
+    print(json.dumps(report, indent=4))
+    path = os.path.join(cfg.retrieval.embed_dir, f"{dataset.config.name}_{report['variant']}_report.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Save report to {path}.")
+
+if __name__ == "__main__":
+    main()
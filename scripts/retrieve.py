@@ -7,6 +7,7 @@ from fix_adamw_patch import *
 
 from mydatasets.base_dataset import BaseDataset
 from retrieval.base_retrieval import BaseRetrieval
+from utils.profiler import profiler
 import hydra
 import importlib
 
@@ -24,6 +25,9 @@ def main(cfg):
     # 检查是否有force_prepare参数
     force_prepare = cfg.get('force_prepare', False)
     retrieval_model.find_top_k(dataset, force_prepare=force_prepare)
+    if dataset.config.profile_dir:
+        path = profiler.export(dataset.config.profile_dir, prefix=f"{dataset.time}-{cfg.retrieval.model_name}")
+        print(f"Save profile to {path}.")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,45 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# 应用AdamW补丁
+from fix_adamw_patch import *
+
+from mydatasets.base_dataset import BaseDataset
+from retrieval.base_retrieval import BaseRetrieval
+from retrieval.server import RetrievalServer
+import hydra
+from hydra.core.hydra_config import HydraConfig
+import importlib
+
+def load_retrieval(retrieval_config) -> BaseRetrieval:
+    module_name, class_name = retrieval_config.class_path.rsplit('.', 1)
+    module = importlib.import_module(module_name)
+    return getattr(module, class_name)(retrieval_config)
+
+@hydra.main(config_path="../config", config_name="base", version_base="1.2")
+def main(cfg):
+    os.environ["CUDA_VISIBLE_DEVICES"] = cfg.retrieval.cuda_visible_devices
+    dataset = BaseDataset(cfg.dataset)
+    # Every retrieval config is composed with the same command line overrides, only the retrieval group changes.
+    hydra_config = HydraConfig.get()
+    overrides = [override for override in hydra_config.overrides.task if not override.startswith("retrieval=")]
+    retrievals = {}
+    for name in cfg.retrieval_server.retrievals:
+        retrieval_cfg = hydra.compose(config_name=hydra_config.job.config_name, overrides=overrides + [f"retrieval={name}"])
+        print(f"Load retrieval {name}: {retrieval_cfg.retrieval.class_path}")
+        retrievals[name] = load_retrieval(retrieval_cfg.retrieval)
+    
+    server = RetrievalServer((cfg.retrieval_server.host, cfg.retrieval_server.port), dataset, retrievals)
+    print(f"Serve {list(retrievals)} for {dataset.config.name} at http://{cfg.retrieval_server.host}:{cfg.retrieval_server.port}.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if dataset.rankings is not None:
+            dataset.rankings.close()
+
+if __name__ == "__main__":
+    main()
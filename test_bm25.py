@@ -0,0 +1,50 @@
+import math
+
+import pytest
+
+from retrieval.bm25_retrieval import LexicalIndex, tokenize
+
+TEXTS = ["Apple banana", "apple apple, cherry", ""]
+
+def test_tokenize():
+    assert tokenize("Apple, banana-split 42") == ["apple", "banana", "split", "42"]
+
+def test_scores_match_hand_computed_bm25():
+    index = LexicalIndex(TEXTS, k1=1.2, b=0.75)
+    # 3 pages of 2, 3 and 0 tokens, so the average length is 5/3.
+    idf_apple = math.log(1 + (3 - 2 + 0.5) / (2 + 0.5))
+    idf_cherry = math.log(1 + (3 - 1 + 0.5) / (1 + 0.5))
+    norm = lambda length: 1.2 * (1 - 0.75 + 0.75 * length / (5 / 3))
+    apple = [idf_apple * 1 * 2.2 / (1 + norm(2)), idf_apple * 2 * 2.2 / (2 + norm(3)), 0.0]
+    assert index.scores("apple").tolist() == pytest.approx(apple, rel=1e-5)
+    cherry = idf_cherry * 1 * 2.2 / (1 + norm(3))
+    assert index.scores("apple cherry").tolist() == pytest.approx([apple[0], apple[1] + cherry, 0.0], rel=1e-5)
+    # A term repeated in the query counts once per occurrence.
+    assert index.scores("apple apple").tolist() == pytest.approx([2 * score for score in apple], rel=1e-5)
+
+def test_search_ranks_every_page():
+    index = LexicalIndex(TEXTS)
+    pages, scores = index.search("cherry apple")
+    assert pages == [1, 0, 2]
+    assert scores[2] == 0.0
+    assert index.search("cherry apple", top_k=1)[0] == [1]
+
+def test_page_ids_filter():
+    index = LexicalIndex(TEXTS)
+    assert index.search("apple", page_id_list=[2, 0, 0, 7])[0] == [0, 2]
+    assert index.search("apple", top_k=1, page_id_list=[0, 2]) == ([0], [pytest.approx(index.scores("apple")[0])])
+    assert index.search("apple", page_id_list=[]) == ([], [])
+
+def test_unknown_words_score_zero():
+    index = LexicalIndex(TEXTS)
+    assert index.scores("durian").tolist() == [0.0, 0.0, 0.0]
+    assert index.search("durian")[0] == [0, 1, 2]
+    assert index.scores("durian banana").tolist() == pytest.approx(index.scores("banana").tolist())
+
+def test_empty_documents():
+    index = LexicalIndex(["", "  \n"])
+    assert len(index) == 2
+    assert index.search("apple") == ([0, 1], [0.0, 0.0])
+    empty = LexicalIndex([])
+    assert len(empty) == 0
+    assert empty.search("apple") == ([], [])
@@ -0,0 +1,54 @@
+import math
+
+import pytest
+import torch
+
+from retrieval.compression import quantize, dequantize, CompressedPages, compression_tag, pool_tokens
+from retrieval.image_retrieval import colbert_scores
+
+def unit_vectors(*shape):
+    torch.manual_seed(0)
+    return torch.nn.functional.normalize(torch.randn(*shape), dim=-1)
+
+def test_compression_tag():
+    assert compression_tag("none", 1) is None
+    assert compression_tag("int8", 2) == "int8-pool2"
+    assert compression_tag("none", 3) == "pool3"
+    with pytest.raises(ValueError):
+        compression_tag("fp4", 1)
+
+def test_int8_round_trip():
+    embeds = unit_vectors(3, 5, 16)
+    codes = quantize(embeds, "int8")
+    assert codes.dtype == torch.int8
+    assert torch.allclose(dequantize(codes, "int8", 16), embeds, atol=0.5 / 127 + 1e-6)
+
+def test_binary_keeps_signs_and_unit_length():
+    embeds = unit_vectors(3, 5, 20)
+    codes = quantize(embeds, "binary")
+    assert codes.shape == (3, 5, math.ceil(20 / 8))
+    vectors = dequantize(codes, "binary", 20)
+    assert torch.equal(vectors > 0, embeds > 0)
+    assert torch.allclose(vectors.norm(dim=-1), torch.ones(3, 5))
+
+def test_pool_tokens_pads_to_a_fixed_shape():
+    embeds = unit_vectors(2, 7, 16)
+    pooled = pool_tokens(embeds, 2)
+    assert pooled.shape == (2, 4, 16)
+    assert torch.allclose(pooled.norm(dim=-1), torch.ones(2, 4), atol=1e-5)
+
+def test_compressed_pages_chunks_match_full_dequantize():
+    embeds = unit_vectors(7, 4, 16)
+    pages = CompressedPages(quantize(embeds, "int8"), "int8", 16)
+    assert len(pages) == 7
+    full = dequantize(pages.codes, "int8", 16)
+    assert torch.equal(torch.cat(list(pages.chunks(chunk_pages=3))), full)
+    index = torch.tensor([5, 1])
+    assert torch.equal(torch.cat(list(pages.index_select(0, index).chunks())), full[index])
+
+def test_scores_on_compressed_pages_match_dequantized():
+    embeds = unit_vectors(40, 4, 16)
+    queries = unit_vectors(3, 2, 16)
+    pages = CompressedPages(quantize(embeds, "int8"), "int8", 16)
+    expected = colbert_scores(queries, dequantize(pages.codes, "int8", 16))
+    assert torch.allclose(colbert_scores(queries, pages), expected, atol=1e-5)
@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+
+import torch
+
+from retrieval import embedding_store
+from retrieval.embedding_store import EmbeddingStore
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+def test_round_trip(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    embeds = torch.randn(3, 4, 8)
+    store.put("doc.pdf", embeds, fingerprint="a")
+    writer = store.writer("pieces.pdf", 3, fingerprint="b")
+    writer.write(0, embeds[:2])
+    writer.write(2, embeds[2:])
+    writer.close()
+    store.flush()
+    reopened = EmbeddingStore(str(tmp_path))
+    assert torch.equal(reopened["doc.pdf"], embeds)
+    assert torch.equal(reopened["pieces.pdf"], embeds)
+    assert reopened.is_current("doc.pdf", "a") and not reopened.is_current("doc.pdf", "b")
+
+def test_stale_tmp_files_are_removed_on_open(tmp_path):
+    path = str(tmp_path / "doc.npy")
+    live = embedding_store.tmp_path(path)
+    dead = live[:-len(f"{os.getpid()}.tmp")] + f"{dead_pid()}.tmp"
+    other_host = f"{path}.elsewhere.{dead_pid()}.tmp"
+    for name in (live, dead, other_host):
+        open(name, "w").close()
+    EmbeddingStore(str(tmp_path))
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(name) for name in (live, other_host))
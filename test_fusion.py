@@ -0,0 +1,34 @@
+from types import SimpleNamespace
+
+import pytest
+
+from retrieval.mix_retrieval import FusionRetrieval
+
+def fusion(kind, rrf_k=60):
+    return FusionRetrieval(SimpleNamespace(fusion=kind, rrf_k=rrf_k))
+
+def test_rrf():
+    pages, scores = fusion("rrf", rrf_k=1).fuse([([0, 1, 2], None, 1.0), ([2, 3], None, 1.0)], [0, 1, 2, 3])
+    assert pages == [2, 0, 1, 3]
+    assert scores == pytest.approx([1 / 4 + 1 / 2, 1 / 2, 1 / 3, 1 / 3])
+
+def test_rrf_keeps_best_rank_of_repeated_page():
+    pages, scores = fusion("rrf", rrf_k=1).fuse([([1, 0, 1], None, 1.0)], [0, 1])
+    assert pages == [1, 0]
+    assert scores == pytest.approx([1 / 2, 1 / 3])
+
+def test_rrf_ties_keep_candidate_order():
+    pages, _ = fusion("rrf").fuse([([0], None, 1.0), ([1], None, 1.0)], [1, 0])
+    assert pages == [1, 0]
+
+def test_score_fusion_normalizes_and_weights():
+    sides = [([0, 1], [10.0, 0.0], 1.0), ([1, 0], [3.0, 1.0], 2.0)]
+    pages, scores = fusion("score").fuse(sides, [0, 1])
+    assert pages == [1, 0]
+    assert scores == pytest.approx([2.0, 1.0])
+
+def test_missing_sides_and_candidates():
+    assert fusion("rrf").fuse([([0], None, 1.0)], []) == ([], [])
+    pages, scores = fusion("score").fuse([([], [], 1.0), ([2], [5.0], 1.0)], [2, 4])
+    assert pages == [2, 4]
+    assert scores == pytest.approx([1.0, 0.0])
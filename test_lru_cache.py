@@ -0,0 +1,57 @@
+from omegaconf import OmegaConf
+
+from benchmarks.synthetic import make_corpus
+from mydatasets.base_dataset import BaseDataset
+from utils.lru_cache import LRUCache
+
+def test_evicts_least_recently_used():
+    evicted = []
+    cache = LRUCache(max_items=2, on_evict=lambda key, value: evicted.append(key))
+    assert cache.get_or_load("a", lambda: 1) == 1
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert evicted == ["b"]
+    assert "a" in cache and "c" in cache
+    assert cache.get_or_load("a", lambda: 10) == 1
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (2, 1, 1)
+
+def test_byte_budget_keeps_current_entry():
+    cache = LRUCache(max_bytes=10, sizeof=len)
+    cache.put("a", "x" * 6)
+    cache.put("b", "x" * 6)
+    assert list(cache.data) == ["b"]
+    cache.put("c", "x" * 20)
+    assert list(cache.data) == ["c"]
+    assert cache.stats()["bytes"] == 20
+
+def test_resize_after_value_grows():
+    cache = LRUCache(max_bytes=10, sizeof=len)
+    a = cache.put("a", [])
+    cache.put("b", [])
+    a.extend(range(8))
+    cache.resize("a")
+    assert cache.stats()["bytes"] == 8
+    cache.get("b").extend(range(8))
+    cache.resize("b")
+    assert list(cache.data) == ["b"]
+    assert cache.stats()["evictions"] == 1
+    cache.resize("missing")
+
+def test_content_cache_budget_is_enforced(tmp_path):
+    root = str(tmp_path)
+    sample_path, _ = make_corpus(root, num_docs=8, pages_per_doc=4, questions_per_doc=1)
+    config = OmegaConf.load("config/dataset/base.yaml")
+    config.update(dict(name="lru", data_dir=root, result_dir=f"{root}/results", extract_path=f"{root}/extract", document_path=f"{root}/documents",
+                       sample_path=sample_path, sample_with_retrieval_path=sample_path, content_cache_mb=10 / 1024))
+    dataset = BaseDataset(config)
+    dataset.extract_content(num_workers=1)
+    budget = dataset.content_cache.max_bytes
+    for sample in dataset.load_data(use_retreival=False):
+        content = dataset.load_processed_content(sample)
+        assert all(page.txt for page in content)
+    stats = dataset.content_cache.stats()
+    assert stats["evictions"] > 0
+    assert 0 < stats["bytes"] <= budget
+    assert sum(content.nbytes for content in dataset.content_cache.data.values()) == stats["bytes"]
@@ -0,0 +1,81 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+from mydatasets import page_store
+
+def png_bytes(color, size=(4, 3)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def write_pages(path, pages):
+    with page_store.PackedPageWriter(path) as writer:
+        for text, image in pages:
+            writer.add_page(text.encode("utf-8"), image, text_length=len(text))
+    return path
+
+def test_packed_round_trip(tmp_path):
+    path = page_store.packed_file(str(tmp_path), "doc")
+    images = [png_bytes("red"), png_bytes("blue", size=(2, 5))]
+    write_pages(path, [("first page", images[0]), ("second", images[1])])
+    reader = page_store.PackedPageReader(path)
+    assert len(reader) == 2
+    assert bytes(reader.read_text_bytes(0)) == b"first page"
+    assert bytes(reader.read_text_bytes(1)) == b"second"
+    assert bytes(reader.read_image_bytes(1)) == images[1]
+    assert reader.pages[0]["text_length"] == len("first page")
+    assert reader.open_image(1).size == (2, 5)
+
+def test_failed_write_leaves_no_file(tmp_path):
+    path = page_store.packed_file(str(tmp_path), "doc")
+    with pytest.raises(RuntimeError):
+        with page_store.PackedPageWriter(path) as writer:
+            writer.add_page(b"text", png_bytes("red"))
+            raise RuntimeError("render failed")
+    assert list(tmp_path.iterdir()) == []
+
+def test_not_a_packed_file(tmp_path):
+    path = tmp_path / "doc.pages"
+    path.write_bytes(b"x" * 64)
+    with pytest.raises(ValueError):
+        page_store.PackedPageReader(str(path))
+
+def test_packed_ref_resolution(tmp_path):
+    path = write_pages(page_store.packed_file(str(tmp_path), "doc"), [("a", png_bytes("red")), ("b", png_bytes("green"))])
+    ref = page_store.packed_ref(path, 1)
+    assert page_store.is_packed_ref(ref)
+    assert page_store.parse_packed_ref(ref) == (path, 1)
+    assert page_store.read_image_bytes(ref) == png_bytes("green")
+    assert page_store.load_image(ref).getpixel((0, 0)) == (0, 128, 0)
+    assert page_store.resolve_image(ref).size == (4, 3)
+
+def test_plain_paths_are_passed_through(tmp_path):
+    path = tmp_path / "page.png"
+    path.write_bytes(png_bytes("red"))
+    assert not page_store.is_packed_ref(str(path))
+    assert page_store.resolve_image(str(path)) == str(path)
+    assert page_store.read_image_bytes(str(path)) == png_bytes("red")
+    assert not page_store.is_packed_ref(None)
+
+def test_rewritten_file_is_reopened(tmp_path):
+    path = write_pages(page_store.packed_file(str(tmp_path), "doc"), [("old", png_bytes("red"))])
+    ref = page_store.packed_ref(path, 0)
+    assert page_store.read_image_bytes(ref) == png_bytes("red")
+    assert page_store.open_packed(path) is page_store.open_packed(path)
+    write_pages(path, [("new text", png_bytes("blue")), ("more", png_bytes("blue"))])
+    assert len(page_store.open_packed(path)) == 2
+    assert page_store.read_image_bytes(ref) == png_bytes("blue")
+
+def test_same_size_rewrite_is_reopened(tmp_path):
+    path = write_pages(page_store.packed_file(str(tmp_path), "doc"), [("old text", png_bytes("red"))])
+    size = os.path.getsize(path)
+    assert bytes(page_store.open_packed(path).read_text_bytes(0)) == b"old text"
+    mtime_ns = os.stat(path).st_mtime_ns
+    write_pages(path, [("new text", png_bytes("red"))])
+    # Filesystems with coarse timestamps can give the rewrite the same mtime; move it forward explicitly.
+    os.utime(path, ns=(mtime_ns + 10**9, mtime_ns + 10**9))
+    assert os.path.getsize(path) == size
+    assert bytes(page_store.open_packed(path).read_text_bytes(0)) == b"new text"
@@ -0,0 +1,54 @@
+import pickle
+from types import SimpleNamespace
+
+from mydatasets.ranking_store import RankingStore, question_hash
+from retrieval.base_retrieval import BaseRetrieval
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "rankings.sqlite")
+    store = RankingStore(path)
+    key = question_hash("what is shown?")
+    assert store.get("colpali", key, "doc") is None
+    store.put("colpali", key, "doc", [2, 0, 1], [0.5, 0.25, 0.125])
+    store.put("colpali", key, "doc", [1, 0], [0.75, 0.5])
+    store.flush()
+    assert store.get("colpali", key, "doc") == ([1, 0], [0.75, 0.5])
+    copy = pickle.loads(pickle.dumps(store))
+    assert copy.conn is None
+    assert copy.get("colpali", key, "doc") == ([1, 0], [0.75, 0.5])
+    store.close()
+    copy.close()
+
+def test_question_hash():
+    assert question_hash("q") == question_hash("q", None)
+    assert question_hash("q") != question_hash("q", [0, 1])
+    assert question_hash("q", None, "a") != question_hash("q", None, "b")
+
+class FakeDataset():
+    def __init__(self, path):
+        self.rankings = RankingStore(path)
+        self.fingerprint = "a"
+
+    def load_processed_content(self, sample):
+        return SimpleNamespace(fingerprint=self.fingerprint)
+
+def make_retrieval(top_k):
+    retrieval = BaseRetrieval(None)
+    retrieval.keys = {"result": "r", "ranking": "r_ranking", "question": "question", "page_id": "page_ids", "doc": "doc_id", "name": "test", "top_k": top_k}
+    return retrieval
+
+def test_rankings_follow_top_k_and_document_pages(tmp_path):
+    dataset = FakeDataset(str(tmp_path / "rankings.sqlite"))
+    sample = {"question": "q", "doc_id": "doc.pdf"}
+    first = make_retrieval(top_k=2)
+    assert not first.load_ranking(dataset, sample, first.keys)
+    first.save_ranking(dataset, sample, first.keys, [3, 1, 2, 0], [4.0, 3.0, 2.0, 1.0])
+    assert sample["r"] == [3, 1] and sample["r_score"] == [4.0, 3.0]
+    wider = make_retrieval(top_k=3)
+    reloaded = {"question": "q", "doc_id": "doc.pdf"}
+    assert wider.load_ranking(dataset, reloaded, wider.keys)
+    assert reloaded["r"] == [3, 1, 2] and reloaded["r_ranking"] == sample["r_ranking"]
+    # The document was extracted again with different pages.
+    dataset.fingerprint = "b"
+    assert not wider.load_ranking(dataset, {"question": "q", "doc_id": "doc.pdf"}, wider.keys)
+    dataset.rankings.close()
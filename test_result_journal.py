@@ -0,0 +1,24 @@
+from mydatasets.result_journal import ResultJournal, read_journal, apply_journal
+
+def test_journal_keeps_latest_result(tmp_path):
+    path = str(tmp_path / "results.journal.jsonl")
+    with ResultJournal(path) as journal:
+        journal.append(0, {"answer": "a"})
+        journal.append(1, {"answer": "b"})
+        journal.append(0, {"answer": "c"})
+    assert read_journal(path) == {0: {"answer": "c"}, 1: {"answer": "b"}}
+
+def test_partial_line_is_dropped_before_appending(tmp_path):
+    path = str(tmp_path / "results.journal.jsonl")
+    with ResultJournal(path) as journal:
+        journal.append(0, {"answer": "a"})
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"index": 1, "res')
+    assert read_journal(path) == {0: {"answer": "a"}}
+    with ResultJournal(path) as journal:
+        journal.append(1, {"answer": "b"})
+    assert read_journal(path) == {0: {"answer": "a"}, 1: {"answer": "b"}}
+
+def test_apply_journal_ignores_unknown_samples():
+    samples = apply_journal([{"q": 0}, {"q": 1}], {0: {"answer": "a"}, 5: {"answer": "x"}})
+    assert samples == [{"q": 0, "answer": "a"}, {"q": 1}]
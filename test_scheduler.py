@@ -0,0 +1,111 @@
+import zlib
+from types import SimpleNamespace
+
+import pytest
+
+from agents.base_agent import AgentCall
+from agents.scheduler import StageScheduler
+
+class EchoModel:
+    """Answers with a checksum of everything it is given; questions containing "fail" raise."""
+    def __init__(self, name, fail_batches=False):
+        self.name = name
+        self.fail_batches = fail_batches
+        self.batches = []
+
+    def predict(self, question, texts=None, images=None, history=None):
+        if "fail" in question:
+            raise RuntimeError(f"cannot answer {question}")
+        messages = list(history or []) + [question]
+        answer = f"{self.name}:{zlib.crc32(repr((messages, texts, images)).encode()):08x}"
+        return answer, messages + [answer]
+
+    def predict_batch(self, requests):
+        self.batches.append(len(requests))
+        results = []
+        for request in requests:
+            if self.fail_batches and len(requests) > 1 and "fail" in request["question"]:
+                # Like the local models, the history is already extended in place when generation fails.
+                if request["history"] is not None:
+                    request["history"].append(request["question"])
+                raise RuntimeError("batch failed")
+            results.append(self.predict(**request))
+        return results
+
+def call(model, stage, question, texts=None, history=None):
+    return AgentCall(SimpleNamespace(model=model), stage, {"question": question, "texts": texts, "images": None, "history": history})
+
+def flow(models, question):
+    """A critic call, then text and image calls together, then a sum call on the critic's history."""
+    critic, messages = yield call(models["critic"], "critic", question)
+    (text, _), (image, _) = yield [
+        call(models["text"], "text", question, texts=[critic]),
+        call(models["image"], "image", question + " image"),
+    ]
+    answer, _ = yield call(models["critic"], "sum", text + image, history=messages)
+    return answer
+
+def run_sequential(flows):
+    """The path without the scheduler: every call is answered alone with predict, errors end the flow."""
+    outcomes = {}
+    for key, running in flows:
+        result = None
+        try:
+            while True:
+                calls = running.throw(result) if isinstance(result, RuntimeError) else running.send(result)
+                try:
+                    answers = [c.agent.model.predict(**c.request) for c in (calls if isinstance(calls, list) else [calls])]
+                    result = answers if isinstance(calls, list) else answers[0]
+                except RuntimeError as e:
+                    result = e
+        except StopIteration as e:
+            outcomes[key] = (e.value, None)
+        except RuntimeError as e:
+            outcomes[key] = (None, str(e))
+    return outcomes
+
+def run_scheduled(flows, batch_samples):
+    return {key: (result, None if error is None else str(error)) for key, result, error in StageScheduler(batch_samples).run(flows)}
+
+def make_models(fail_batches=False):
+    return {name: EchoModel(name, fail_batches) for name in ("critic", "text", "image")}
+
+QUESTIONS = ["what is shown", "who wrote it", "when", "fail on the image", "how many pages", "where"]
+
+@pytest.mark.parametrize("batch_samples", [2, 4, 16])
+def test_scheduled_answers_equal_sequential(batch_samples):
+    models = make_models()
+    expected = run_sequential((i, flow(models, q)) for i, q in enumerate(QUESTIONS))
+    models = make_models()
+    assert run_scheduled(((i, flow(models, q)) for i, q in enumerate(QUESTIONS)), batch_samples) == expected
+    assert run_scheduled(((i, flow(models, q)) for i, q in enumerate(QUESTIONS)), 1) == expected
+    assert expected[3] == (None, "cannot answer fail on the image")
+    assert max(models["critic"].batches) == min(batch_samples, len(QUESTIONS))
+
+def test_failed_batch_is_retried_one_by_one():
+    models = make_models()
+    expected = run_sequential((i, flow(models, q)) for i, q in enumerate(QUESTIONS))
+    models = make_models(fail_batches=True)
+    assert run_scheduled(((i, flow(models, q)) for i, q in enumerate(QUESTIONS)), 8) == expected
+    assert models["critic"].batches[0] == len(QUESTIONS)
+    assert sum(answer is not None for answer, _ in expected.values()) == len(QUESTIONS) - 1
+
+def test_history_survives_failed_batch():
+    models = make_models(fail_batches=True)
+    history = ["earlier"]
+    calls = [call(models["critic"], "sum", "fine", history=history), call(models["critic"], "sum", "fail", history=history)]
+    results = StageScheduler(2).answer(calls)
+    assert history == ["earlier"]
+    assert results[0] == models["critic"].predict("fine", history=["earlier"])
+    assert isinstance(results[1], RuntimeError)
+
+def test_flows_are_read_lazily():
+    opened = []
+    def flows():
+        for i, q in enumerate(QUESTIONS):
+            opened.append(i)
+            yield i, flow(make_models(), q)
+    finished = StageScheduler(2).run(flows())
+    next(finished)
+    assert len(opened) <= 3
+    assert len(list(finished)) == len(QUESTIONS) - 1
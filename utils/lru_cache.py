@@ -0,0 +1,104 @@
+import threading
+from collections import OrderedDict
+
+class LRUCache():
+    """
+    Least-recently-used cache bounded by an item count and/or a byte budget.
+    :param max_items: Maximum number of entries, None for no limit.
+    :param max_bytes: Maximum total size reported by `sizeof`, None for no limit.
+    :param sizeof: Callable returning the size of a value in bytes.
+    :param on_evict: Optional callable(key, value) run when an entry is evicted.
+    """
+    def __init__(self, max_items=None, max_bytes=None, sizeof=None, on_evict=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof if sizeof is not None else (lambda value: 0)
+        self.on_evict = on_evict
+        self.data = OrderedDict()
+        self.sizes = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.data:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.data.move_to_end(key)
+            # Values may grow after they are cached (e.g. lazily loaded pages), so re-measure on access.
+            self._measure(key)
+            self._evict(keep=key)
+            return self.data[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            self._measure(key)
+            self._evict(keep=key)
+            return value
+
+    def resize(self, key):
+        """Re-measure an entry whose value grew after it was cached, evicting others if it is now over budget."""
+        with self.lock:
+            if key in self.data:
+                self._measure(key)
+                self._evict(keep=key)
+
+    def get_or_load(self, key, loader):
+        with self.lock:
+            value = self.get(key, None)
+            if value is None and key not in self.data:
+                value = self.put(key, loader())
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.sizes.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "items": len(self.data),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _measure(self, key):
+        size = self.sizeof(self.data[key])
+        self.total_bytes += size - self.sizes.get(key, 0)
+        self.sizes[key] = size
+
+    def _evict(self, keep=None):
+        while self.data and self._over_budget():
+            key = next(iter(self.data))
+            if key == keep:
+                # Never evict the entry that is being handed out.
+                break
+            value = self.data.pop(key)
+            self.total_bytes -= self.sizes.pop(key)
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(key, value)
+
+    def _over_budget(self):
+        if self.max_items is not None and len(self.data) > self.max_items:
+            return True
+        if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+            return True
+        return False
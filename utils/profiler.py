@@ -0,0 +1,192 @@
+import contextvars
+import csv
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+_current_sample = contextvars.ContextVar("profile_sample", default=None)
+_current_span = contextvars.ContextVar("profile_span", default=None)
+
+FIELDS = ["sample", "stage", "seconds", "prompt_tokens", "generated_tokens", "images"]
+
+class Span():
+    def __init__(self, stage, sample):
+        self.stage = stage
+        self.sample = sample
+        self.seconds = 0.0
+        self.prompt_tokens = 0
+        self.generated_tokens = 0
+        self.images = 0
+
+    def update(self, prompt_tokens=0, generated_tokens=0, images=0):
+        self.prompt_tokens += prompt_tokens
+        self.generated_tokens += generated_tokens
+        self.images += images
+
+    def as_row(self):
+        return [self.sample, self.stage, self.seconds, self.prompt_tokens, self.generated_tokens, self.images]
+
+class Profiler():
+    """
+    Collects wall time, token and image counts per stage and per sample.
+    Stages are opened with `span(name)`; the sample a span belongs to is set with `sample(sample_id)`.
+    Both are tracked with contextvars, so spans opened from worker threads stay separate.
+    """
+    def __init__(self):
+        self.enabled = True
+        self.rows = []
+        self.totals = {}
+        self.samples = set()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def sample(self, sample_id):
+        token = _current_sample.set(sample_id)
+        try:
+            yield
+        finally:
+            _current_sample.reset(token)
+
+    @contextmanager
+    def span(self, stage):
+        span = Span(stage, _current_sample.get())
+        if not self.enabled:
+            yield span
+            return
+        token = _current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span.seconds = time.perf_counter() - start
+            _current_span.reset(token)
+            self._add(span)
+
+    def current_span(self):
+        return _current_span.get()
+
+    def _add(self, span):
+        with self.lock:
+            self.rows.append(span.as_row())
+            if span.sample is not None:
+                self.samples.add(span.sample)
+            total = self.totals.setdefault(span.stage, [0, 0.0, 0, 0, 0])
+            total[0] += 1
+            total[1] += span.seconds
+            total[2] += span.prompt_tokens
+            total[3] += span.generated_tokens
+            total[4] += span.images
+
+    def summary(self):
+        with self.lock:
+            seconds_by_stage = {}
+            for row in self.rows:
+                seconds_by_stage.setdefault(row[1], []).append(row[2])
+            summary = {}
+            for stage, (calls, seconds, prompt_tokens, generated_tokens, images) in self.totals.items():
+                durations = sorted(seconds_by_stage.get(stage, []))
+                summary[stage] = {
+                    "calls": calls,
+                    "seconds": seconds,
+                    "mean_seconds": seconds / calls if calls else 0.0,
+                    "p50_seconds": percentile(durations, 0.5),
+                    "p95_seconds": percentile(durations, 0.95),
+                    "prompt_tokens": prompt_tokens,
+                    "generated_tokens": generated_tokens,
+                    "images": images,
+                }
+            return summary
+
+    def per_sample(self):
+        with self.lock:
+            result = {}
+            for sample, stage, seconds, prompt_tokens, generated_tokens, images in self.rows:
+                if sample is None:
+                    continue
+                stats = result.setdefault(str(sample), {}).setdefault(stage, {"calls": 0, "seconds": 0.0, "prompt_tokens": 0, "generated_tokens": 0, "images": 0})
+                stats["calls"] += 1
+                stats["seconds"] += seconds
+                stats["prompt_tokens"] += prompt_tokens
+                stats["generated_tokens"] += generated_tokens
+                stats["images"] += images
+            return result
+
+    def export(self, profile_dir, prefix):
+        """
+        Write <prefix>_profile.json (per-stage summary and per-sample breakdown), <prefix>_profile.csv (one row per span)
+        and metrics.prom (Prometheus text format).
+        """
+        os.makedirs(profile_dir, exist_ok=True)
+        json_path = os.path.join(profile_dir, prefix + "_profile.json")
+        with open(json_path, "w") as f:
+            json.dump({"stages": self.summary(), "samples": self.per_sample()}, f, indent=4)
+        with self.lock:
+            rows = list(self.rows)
+        with open(os.path.join(profile_dir, prefix + "_profile.csv"), "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(FIELDS)
+            writer.writerows(rows)
+        self.export_prometheus(os.path.join(profile_dir, "metrics.prom"))
+        return json_path
+
+    def export_prometheus(self, path):
+        with self.lock:
+            totals = {stage: list(total) for stage, total in self.totals.items()}
+            num_samples = len(self.samples)
+        metrics = [
+            ("mdocagent_stage_calls_total", "counter", "Number of calls per stage.", 0),
+            ("mdocagent_stage_seconds_total", "counter", "Wall time spent per stage.", 1),
+            ("mdocagent_stage_prompt_tokens_total", "counter", "Prompt tokens per stage.", 2),
+            ("mdocagent_stage_generated_tokens_total", "counter", "Generated tokens per stage.", 3),
+            ("mdocagent_stage_images_total", "counter", "Images sent per stage.", 4),
+        ]
+        lines = []
+        for name, kind, help_text, column in metrics:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for stage, total in sorted(totals.items()):
+                lines.append(f'{name}{{stage="{stage}"}} {total[column]}')
+        lines.append("# HELP mdocagent_samples_total Samples with at least one recorded stage.")
+        lines.append("# TYPE mdocagent_samples_total counter")
+        lines.append(f"mdocagent_samples_total {num_samples}")
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Scrapers may read the file at any time, so replace it atomically.
+        with open(path + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+        return path
+
+    def reset(self):
+        with self.lock:
+            self.rows = []
+            self.totals = {}
+            self.samples = set()
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+profiler = Profiler()
+
+def get_profiler():
+    return profiler
+
+def record(prompt_tokens=0, generated_tokens=0, images=0):
+    """Add counts to the innermost open span, if any."""
+    span = _current_span.get()
+    if span is not None:
+        span.update(prompt_tokens=prompt_tokens, generated_tokens=generated_tokens, images=images)
+
+def profile_stage(prefix, name=None):
+    """Decorate a method so every call is timed as the stage <prefix>/<name or class name>."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            with profiler.span(f"{prefix}/{name or type(self).__name__}"):
+                return fn(self, *args, **kwargs)
+        return wrapper
+    return decorator